@@ -2,9 +2,13 @@ import argparse
 import logging
 import discord
 from elasticsearch_dsl.connections import connections
+from bsg.byc import ByYourCommand
+from bsg.client import shared_client
 from bsg.command import Command
 from bsg.context import DiscordContext
 from bsg.config import Config
+from bsg.image import Images
+from bsg.thread import ThreadPoller
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Command-line bot reply')
@@ -24,6 +28,7 @@ client = discord.Client()
 client.bsg_app_info = None
 connections.create_connection(alias='main',
                               hosts=[config['elasticsearch_host']])
+config.apply()
 
 @client.event
 async def on_ready():
@@ -50,4 +55,18 @@ async def on_message(message):
     await Command.execute(context, command, arguments)
 
 if __name__ == "__main__":
-    client.run(config['token'])
+    if 'script_url' in config and 'byc_worker' not in config:
+        ByYourCommand.pool.warm()
+        ByYourCommand.pool.start(client.loop)
+    Images.store.load()
+    poll_interval = int(config.get('poll_interval', 30))
+    if 'thread_id' in config and poll_interval > 0:
+        poller = ThreadPoller(config['api_url'], [config['thread_id']],
+                              min_interval=poll_interval,
+                              max_interval=int(config.get('poll_max_interval',
+                                                          600)))
+        poller.start(client.loop)
+    try:
+        client.run(config['token'])
+    finally:
+        shared_client.close()
@@ -1,3 +1,4 @@
+from copy import deepcopy
 import logging
 import re
 from pathlib import PurePath
@@ -33,15 +34,66 @@ class BBCode:
     def _parse_imageid(self, tag_name, value, options, parent, context):
         return options.get(tag_name, '').split(' ')[0]
 
+    def _get_lookup(self, quotes):
+        """
+        Retrieve the `tags` and `download` arguments of the image lookup that
+        the formatter performs for an image within quotes by the given users.
+        """
+
+        return False, True
+
+    def prefetch(self, text):
+        """
+        Retrieve the images that formatting a string of BBCode text looks up
+        concurrently, such that formatting it afterward only finds images
+        that are already available. Image tags are found in a single pass over
+        the tokens of the text without formatting it.
+        """
+
+        lookups = {}
+        quotes = []
+        for token_type, tag_name, options, _ in self.parser.tokenize(text):
+            if tag_name == 'q':
+                if token_type == Parser.TOKEN_TAG_START:
+                    quotes.append(options.get('q', ''))
+                elif token_type == Parser.TOKEN_TAG_END and quotes:
+                    quotes.pop()
+            elif tag_name == 'imageid' and \
+                token_type == Parser.TOKEN_TAG_START:
+                image_id = options.get(tag_name, '').split(' ')[0]
+                lookups.setdefault(self._get_lookup(quotes), []).append(image_id)
+
+        for (tags, download), image_ids in lookups.items():
+            self.images.prefetch(image_ids, tags=tags, download=download)
+
     def process_bbcode(self, text):
         """
         Process a string of BBCode text to a Markdown-like format usable in
         for example Discord.
         """
 
+        self.prefetch(text)
         self._reset()
         return self.parser.format(text)
 
+    def get_state(self):
+        """
+        Retrieve the parse results of the most recently processed text, such
+        that they can be restored with `set_state` without processing again.
+        """
+
+        return deepcopy({
+            "quotes": self._quotes,
+            "image_data": self.image_data,
+            "bold_text": self.bold_text
+        })
+
+    def set_state(self, state):
+        state = deepcopy(state)
+        self._quotes = state["quotes"]
+        self.image_data = state["image_data"]
+        self.bold_text = state["bold_text"]
+
     @property
     def game_state(self):
         return self._quotes["game_state"]
@@ -80,6 +132,13 @@ class BBCodeMarkdown(BBCode):
 
         return value
 
+    def _get_lookup(self, quotes):
+        # Images in the game state are looked up by its HTML formatter
+        if any("BYC: Game State" in quote for quote in quotes):
+            return False, True
+
+        return True, False
+
     def _parse_imageid(self, tag_name, value, options, parent, context):
         image_id = super()._parse_imageid(tag_name, value, options, parent,
                                           context)
@@ -192,7 +251,8 @@ class BBCodeHTML(BBCode):
         # Retrieve images via API
         path = self.images.retrieve(image_id)
         if isinstance(path, PurePath):
-            return f'<div class="img"><img src="{path.resolve().as_uri()}"></div>'
+            # Images are served next to the game state page
+            return f'<div class="img"><img src="/{path.as_posix()}"></div>'
         if not isinstance(path, dict):
             return f'<div class="img">{image_id}</div>'
 
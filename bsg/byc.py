@@ -3,20 +3,31 @@ Standalone interpreter of the BYC script that runs it in a sandbox and stores
 game states.
 """
 
+import asyncio
 from base64 import b64encode, b64decode, urlsafe_b64encode, urlsafe_b64decode
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import sha1
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
 import logging
-from pathlib import Path
+import mimetypes
+from pathlib import Path, PurePosixPath
 import re
+import select
+import socket
+from threading import Lock, Thread
+import time
+import zlib
 from markdownify import markdownify
 import requests
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
-from selenium.webdriver.support.expected_conditions import \
-    visibility_of_element_located, invisibility_of_element
-from selenium.webdriver.support.wait import WebDriverWait
+from selenium.common.exceptions import NoSuchElementException, \
+    TimeoutException, WebDriverException
+from .files import write_atomic
 
 ROLE_TEXT = {
     "character":
@@ -44,25 +55,35 @@ class Dialog:
     MSG_TAGS = ['b', 'i', 'br', 'strong', 'em']
 
     def __init__(self, dialog):
-        self.element = dialog
-
-        msg = dialog.find_element_by_class_name("msg").get_attribute("innerHTML")
-        self.msg = markdownify(msg, convert=self.MSG_TAGS).replace('****', '')
-
+        self.element = dialog["element"]
+        self.description = {
+            "msg": dialog["msg"],
+            "buttons": dialog["buttons"],
+            "input": dialog["input"]
+        }
+        self.msg = markdownify(dialog["msg"], convert=self.MSG_TAGS) \
+            .replace('****', '')
+        self.input = dialog["input"]
         self.buttons = []
-        self.button_elements = []
-        try:
-            self.input = dialog.find_element_by_css_selector("input[type=text]")
-        except NoSuchElementException:
-            self.input = False
         self.options = {}
+        self._button_elements = None
 
-        buttons = dialog.find_elements_by_tag_name("button")
-        for index, button in enumerate(buttons):
-            self.button_elements.append(button)
-            self.buttons.append(button.get_attribute("innerText"))
+        for index, button in enumerate(dialog["buttons"]):
+            self.buttons.append(button["innerText"])
             for attribute in self.BUTTON_ATTRIBUTES:
-                self.options[button.get_attribute(attribute)] = index
+                self.options[button[attribute]] = index
+
+    @property
+    def button_elements(self):
+        if self._button_elements is None:
+            self._button_elements = \
+                self.element.find_elements_by_tag_name("button")
+
+        return self._button_elements
+
+    @property
+    def input_element(self):
+        return self.element.find_element_by_css_selector("input[type=text]")
 
     def __repr__(self):
         options = urlsafe_b64encode(json.dumps(self.options).encode()).decode()
@@ -77,35 +98,659 @@ class Dialog:
     # quote this post | use **!byc** in their private channel | ???
     # BGG             | Discord                               | command line
 
+class DriverPool:
+    """
+    Pool of headless Chrome web drivers that are launched in advance and
+    reused by BYC games. Idle drivers are kept up to the size of the pool.
+    A driver is reset when it is returned and checked when it is borrowed.
+    Drivers are quit after a maximum number of uses or when they have been
+    idle for too long, and the pool is periodically topped up again.
+    """
+
+    def __init__(self, size=1, max_uses=50, idle_timeout=1800,
+                 interval=60):
+        self.size = size
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.idle = []
+        self.uses = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def _create():
+        # Create the Selenium web driver (no screen necesarry, file access)
+        options = Options()
+        options.headless = True
+        driver = webdriver.Chrome(chrome_options=options)
+        driver.set_window_size(600, 1600)
+        return driver
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            driver.quit()
+        except:
+            pass
+
+    @staticmethod
+    def _check(driver):
+        try:
+            return driver.execute_script("return 1;") == 1
+        except WebDriverException:
+            return False
+
+    @staticmethod
+    def _reset(driver):
+        try:
+            driver.execute_script("window.localStorage.clear(); "
+                                  "window.sessionStorage.clear();")
+        except WebDriverException:
+            pass
+
+        try:
+            driver.delete_all_cookies()
+            driver.get("about:blank")
+            return True
+        except WebDriverException:
+            return False
+
+    def _evict(self):
+        expired = time.monotonic() - self.idle_timeout
+        with self.lock:
+            evicted = [driver for driver, since in self.idle if since < expired]
+            self.idle = [
+                (driver, since) for driver, since in self.idle
+                if since >= expired
+            ]
+
+        for driver in evicted:
+            logging.info("Quitting idle web driver")
+            self.uses.pop(driver, None)
+            self._quit(driver)
+
+    def warm(self):
+        """
+        Launch web drivers until the pool has its size in idle drivers.
+        """
+
+        while len(self.idle) < self.size:
+            try:
+                driver = self._create()
+            except WebDriverException:
+                logging.exception("Could not launch web driver")
+                return
+
+            with self.lock:
+                self.uses[driver] = 0
+                self.idle.append((driver, time.monotonic()))
+
+    def maintain(self):
+        """
+        Quit web drivers that have been idle for too long and launch new
+        drivers to replace them and the borrowed drivers.
+        """
+
+        self._evict()
+        self.warm()
+
+    async def keep_warm(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await loop.run_in_executor(None, self.maintain)
+            except Exception:
+                logging.exception("Could not maintain web driver pool")
+
+    def start(self, loop):
+        """
+        Create a task in the event loop that maintains the pool periodically.
+        """
+
+        return loop.create_task(self.keep_warm())
+
+    def acquire(self):
+        """
+        Borrow a healthy web driver from the pool, or launch a new driver if
+        there is no idle driver.
+        """
+
+        self._evict()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                driver, _ = self.idle.pop()
+
+            if self._check(driver):
+                self.uses[driver] += 1
+                return driver
+
+            logging.warning("Quitting unresponsive web driver")
+            self.uses.pop(driver, None)
+            self._quit(driver)
+
+        driver = self._create()
+        self.uses[driver] = 1
+        return driver
+
+    def release(self, driver):
+        """
+        Return a borrowed web driver to the pool after resetting its page and
+        storage, or quit it if the pool is full, it has been used too often
+        or it could not be reset.
+        """
+
+        self._evict()
+        if self.uses.get(driver, self.max_uses) < self.max_uses and \
+            self._reset(driver):
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append((driver, time.monotonic()))
+                    return
+
+        self.uses.pop(driver, None)
+        self._quit(driver)
+
+class PageRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler for requests to the BYC page server.
+    """
+
+    def do_GET(self):
+        resource = self.server.page_server.get(self.path.lstrip("/"))
+        if resource is None:
+            self.send_error(404)
+            return
+
+        body, content_type, etag = resource
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is None:
+            self.send_header("Cache-Control", "no-store")
+        else:
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Page server: %s", format % args)
+
+class PageServer:
+    """
+    HTTP server on the local host that serves BYC pages from memory in
+    a background thread. Static files, such as the BYC script, are read
+    once and kept in memory until they change on disk. They are served with
+    an entity tag, so that the browser reuses its cached copy and compiled
+    code of the script when it loads another page. Files in directories,
+    such as fonts and images, are read from disk when they are requested.
+    """
+
+    def __init__(self, files, directories=None, host="127.0.0.1"):
+        self.files = files
+        self.directories = directories if directories is not None else {}
+        self.host = host
+        self.pages = {}
+        self.cache = {}
+        self.lock = Lock()
+        self.httpd = None
+
+    def start(self):
+        """
+        Start serving on a free port if the server is not yet running.
+        """
+
+        with self.lock:
+            if self.httpd is not None:
+                return
+
+            self.httpd = ThreadingHTTPServer((self.host, 0), PageRequestHandler)
+            self.httpd.daemon_threads = True
+            self.httpd.page_server = self
+
+        thread = Thread(target=self.httpd.serve_forever, name="page-server",
+                        daemon=True)
+        thread.start()
+        logging.info("Serving BYC pages on port %d", self.httpd.server_port)
+
+    def get_url(self, path):
+        self.start()
+        return f"http://{self.host}:{self.httpd.server_port}/{path}"
+
+    def add_page(self, name, html):
+        """
+        Store the HTML of a page and return its path on the server.
+        """
+
+        self.pages[name] = html.encode()
+        return f"page/{name}"
+
+    def remove_page(self, name):
+        self.pages.pop(name, None)
+
+    def _load_file(self, name):
+        file_path, _ = self.files[name]
+        version = file_path.stat().st_mtime_ns
+        cached = self.cache.get(name)
+        if cached is None or cached[0] != version:
+            cached = (version, file_path.read_bytes())
+            self.cache[name] = cached
+
+        return cached
+
+    def _get_directory_file(self, directory, name):
+        parts = PurePosixPath(name).parts
+        if not parts or ".." in parts or parts[0] == "/":
+            return None
+
+        file_path = self.directories[directory].joinpath(*parts)
+        try:
+            version = file_path.stat().st_mtime_ns
+            body = file_path.read_bytes()
+        except OSError:
+            return None
+
+        content_type = mimetypes.guess_type(file_path.name)[0]
+        if content_type is None:
+            content_type = "application/octet-stream"
+
+        return body, content_type, f'"{version}"'
+
+    def get(self, path):
+        """
+        Retrieve the body, content type and entity tag of a page or static
+        file, or `None` if the path is unknown. Pages have no entity tag.
+        """
+
+        path = path.partition("?")[0]
+        if path.startswith("page/"):
+            body = self.pages.get(path[len("page/"):])
+            if body is None:
+                return None
+
+            return body, "text/html", None
+
+        directory, _, name = path.partition("/")
+        if directory in self.directories and name != "":
+            return self._get_directory_file(directory, name)
+
+        if path not in self.files:
+            return None
+
+        try:
+            version, body = self._load_file(path)
+        except OSError:
+            return None
+
+        return body, self.files[path][1], f'"{version}"'
+
+class BusyError(RuntimeError):
+    """
+    Error raised when too much BYC work is already waiting for a game.
+    """
+
+class GameWorkers:
+    """
+    Executor of blocking BYC work, such as web driver interaction, in worker
+    threads so that the event loop stays responsive. Work for the same game
+    runs one call at a time in the order it was submitted, while work for
+    different games runs in parallel. At most `max_pending` calls may be
+    running or waiting for each game.
+    """
+
+    def __init__(self, max_workers=4, max_pending=8):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.locks = {}
+        self.depths = Counter()
+        self.stats = Counter()
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                               thread_name_prefix="byc")
+
+        return self.executor
+
+    async def run(self, game_id, function, *args, **kw):
+        """
+        Call a function in a worker thread once the earlier work for the game
+        is done, and return its result.
+        """
+
+        if self.depths[game_id] >= self.max_pending:
+            self.stats["rejected"] += 1
+            raise BusyError(f"Too much pending BYC work for game {game_id}")
+
+        return await self.finish(game_id, function, *args, **kw)
+
+    async def finish(self, game_id, function, *args, **kw):
+        """
+        Call a function in a worker thread once the earlier work for the game
+        is done, regardless of the number of pending calls. This is meant for
+        cleanup work that must not be rejected.
+        """
+
+        self.depths[game_id] += 1
+        self.stats["submitted"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"],
+                                      self.depths[game_id])
+        lock = self.locks.setdefault(game_id, asyncio.Lock())
+        try:
+            async with lock:
+                loop = asyncio.get_event_loop()
+                future = loop.run_in_executor(self._get_executor(),
+                                              partial(function, *args, **kw))
+                try:
+                    result = await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # Keep later work for the game waiting until the thread
+                    # is actually done
+                    await asyncio.wait([future])
+                    raise
+                except:
+                    self.stats["failed"] += 1
+                    raise
+
+                self.stats["completed"] += 1
+                return result
+        finally:
+            self.depths[game_id] -= 1
+            if self.depths[game_id] <= 0:
+                del self.depths[game_id]
+                self.locks.pop(game_id, None)
+
+    def get_stats(self):
+        """
+        Retrieve the number of submitted, completed, failed and rejected
+        calls, the maximum queue depth of a game, and the current number of
+        pending calls per game.
+        """
+
+        stats = dict(self.stats)
+        stats["depths"] = dict(self.depths)
+        stats["pending"] = sum(self.depths.values())
+        return stats
+
+class RenderCache:
+    """
+    Store of rendered game state screenshots, keyed by game and a hash of the
+    game state text and the contents of the source files that affect the
+    rendering, such as the script and the stylesheet. Entries are kept as
+    files in the game directory, so that they are removed along with the
+    other files of the game, and the least recently used entries are removed
+    when there are more than the size. A size of zero disables the cache.
+    """
+
+    def __init__(self, path=Path("game"), size=16, sources=()):
+        self.path = path
+        self.size = size
+        self.sources = sources
+        self.digests = {}
+        self.lock = Lock()
+
+    def _get_digest(self, path):
+        """
+        Retrieve the SHA-1 hash of the contents of a source file, which is
+        only calculated again when the file changed, or an empty string if
+        the file does not exist.
+        """
+
+        try:
+            stat = path.stat()
+        except OSError:
+            return ""
+
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.digests.get(path)
+            if cached is None or cached[0] != version:
+                cached = (version, sha1(path.read_bytes()).hexdigest())
+                self.digests[path] = cached
+
+        return cached[1]
+
+    def get_key(self, game_id, game_state):
+        state_hash = sha1(game_state.encode())
+        for path in self.sources:
+            state_hash.update(self._get_digest(path).encode())
+
+        return f"game-state-{game_id}-render-{state_hash.hexdigest()}"
+
+    def get(self, key):
+        """
+        Retrieve a cached screenshot as an in-memory PNG file, or `None` if
+        the game state was not rendered.
+        """
+
+        if self.size <= 0:
+            return None
+
+        image_path = self.path / f"{key}.png"
+        with self.lock:
+            try:
+                screenshot = image_path.read_bytes()
+            except IOError:
+                return None
+
+            # Mark the entry as recently used
+            image_path.touch()
+
+        image = BytesIO(screenshot)
+        image.name = image_path.name
+        return image
+
+    def put(self, key, image):
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            self.path.mkdir(exist_ok=True)
+            write_atomic(self.path / f"{key}.png", image.getvalue())
+
+            entries = sorted(self.path.glob("game-state-*-render-*.png"),
+                             key=lambda path: path.stat().st_mtime)
+            for path in entries[:max(0, len(entries) - self.size)]:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
 class ByYourCommand:
     """
     By Your Command game.
     """
 
     SCRIPT_PATH = Path("byc.js")
+    SCRIPT_META_PATH = Path("byc.js.json")
+    SCRIPT_VERSIONS_PATH = Path("byc_versions")
+    SCRIPT_PARTS = ("A", "B", "C", "D", "E", "F")
+    SCRIPT_MARKER_REGEX = re.compile(r"(START|END)BYC(?=(.?))")
     STYLE_PATH = Path("game_state.css")
+    SCREENSHOT_MARGIN = 5
+    BOUNDS_SCRIPT = r"""
+        var margin = arguments[0];
+        var bounds = null;
+        function extend(rect) {
+            if (rect.width === 0 || rect.height === 0) {
+                return;
+            }
+            if (bounds === null) {
+                bounds = [rect.left, rect.top, rect.right, rect.bottom];
+            }
+            else {
+                bounds = [
+                    Math.min(bounds[0], rect.left),
+                    Math.min(bounds[1], rect.top),
+                    Math.max(bounds[2], rect.right),
+                    Math.max(bounds[3], rect.bottom)
+                ];
+            }
+        }
+        function paints(element) {
+            if (element.tagName === "IMG") {
+                return true;
+            }
+            var style = window.getComputedStyle(element);
+            return style.backgroundImage !== "none" ||
+                !/^(transparent|rgba\(.*, 0\))$/.test(style.backgroundColor) ||
+                parseFloat(style.borderTopWidth) > 0 ||
+                parseFloat(style.borderRightWidth) > 0 ||
+                parseFloat(style.borderBottomWidth) > 0 ||
+                parseFloat(style.borderLeftWidth) > 0;
+        }
+        var walker = document.createTreeWalker(document.body,
+            NodeFilter.SHOW_ELEMENT | NodeFilter.SHOW_TEXT);
+        var range = document.createRange();
+        while (walker.nextNode()) {
+            var node = walker.currentNode;
+            if (node.nodeType === Node.TEXT_NODE) {
+                if (node.data.trim() !== "") {
+                    range.selectNodeContents(node);
+                    extend(range.getBoundingClientRect());
+                }
+            }
+            else if (paints(node)) {
+                extend(node.getBoundingClientRect());
+            }
+        }
+        if (bounds === null) {
+            return null;
+        }
+        return [
+            Math.max(0, Math.floor(bounds[0]) - margin),
+            Math.max(0, Math.floor(bounds[1]) - margin),
+            Math.min(window.innerWidth, Math.ceil(bounds[2]) + margin),
+            Math.min(window.innerHeight, Math.ceil(bounds[3]) + margin)
+        ];"""
     GAME_SEED_REGEX = re.compile(r"(?:\[c\])?\[size=(?:1|0)\]\[color=#(?:F4F4FF|FFFFFF)\]New seed: (\S+)\[/color\]\[/size](?:\[/c\])?")
     QUOTE_REGEX = re.compile(r'\[q="([^"]+)"\](.*)\[/q\]', re.S)
 
+    DIALOG_TIMEOUT = 2
+
+    # Script that resolves as soon as a dialog is shown, with its element,
+    # message HTML, button attributes and whether it has a text input, or as
+    # soon as the provided dialog is hidden or removed. A mutation observer on
+    # the page detects the changes. Resolves with `false` after the timeout in
+    # milliseconds.
+    WAIT_SCRIPT = '''
+        var done = arguments[arguments.length - 1];
+        var timeout = arguments[0], element = arguments[1];
+        function visible(node) {
+            return (node.offsetWidth > 0 || node.offsetHeight > 0) &&
+                window.getComputedStyle(node).visibility !== "hidden";
+        }
+        function describe(dialog) {
+            var msg = dialog.getElementsByClassName("msg")[0];
+            var buttons = dialog.getElementsByTagName("button");
+            var result = {
+                element: dialog,
+                msg: msg ? msg.innerHTML : "",
+                buttons: [],
+                input: dialog.querySelector("input[type=text]") !== null
+            };
+            for (var i = 0; i < buttons.length; i++) {
+                result.buttons.push({
+                    "class": buttons[i].getAttribute("class"),
+                    "innerText": buttons[i].innerText
+                });
+            }
+            return result;
+        }
+        function check() {
+            if (element) {
+                return !document.documentElement.contains(element) ||
+                    !visible(element);
+            }
+            var dialogs = document.getElementsByClassName("dialog");
+            for (var i = 0; i < dialogs.length; i++) {
+                if (visible(dialogs[i])) {
+                    return describe(dialogs[i]);
+                }
+            }
+            return false;
+        }
+        var result = check();
+        if (result) {
+            done(result);
+            return;
+        }
+        var timer = null;
+        var observer = new MutationObserver(function() {
+            var result = check();
+            if (result) {
+                observer.disconnect();
+                window.clearTimeout(timer);
+                done(result);
+            }
+        });
+        observer.observe(document.documentElement, {
+            childList: true, subtree: true, attributes: true,
+            attributeFilter: ["class", "style", "hidden"]
+        });
+        timer = window.setTimeout(function() {
+            observer.disconnect();
+            done(false);
+        }, timeout);
+    '''
+
+    pool = DriverPool()
+    workers = GameWorkers()
+    script_lock = Lock()
+    renders = RenderCache(sources=(SCRIPT_PATH, STYLE_PATH))
+    server = PageServer({
+        "byc.js": (SCRIPT_PATH, "text/javascript"),
+        "game_state.css": (STYLE_PATH, "text/css")
+    }, {
+        "fonts": Path("fonts"),
+        "images": Path("images")
+    })
+
+    game_class = None
+
     def __init__(self, game_id, user, script_url):
         self.driver = None
         self.game_id = game_id
         self.user = user
+        self.page_name = f"page-{game_id}-{unique_hash(user)}"
         self.script_url = script_url
         self.load()
 
     def __del__(self):
         self.stop()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
     def stop(self):
+        self.server.remove_page(self.page_name)
         if self.driver is not None:
-            try:
-                self.driver.quit()
-            except:
-                pass
-
+            self.pool.release(self.driver)
             self.driver = None
 
+    @classmethod
+    def create(cls, game_id, user, script_url):
+        """
+        Start a BYC game, which runs in a BYC worker process if workers are
+        in use.
+        """
+
+        game_class = cls.game_class if cls.game_class is not None else cls
+        return game_class(game_id, user, script_url)
+
     def load(self):
         """
         Load the script, web driver and other parsers for the BYC game.
@@ -113,20 +758,13 @@ class ByYourCommand:
 
         # Load script
         if not self.SCRIPT_PATH.exists():
-            script = self._load_script()
-            with self.SCRIPT_PATH.open('w') as script_file:
-                script_file.write(script)
+            self._update_script()
 
         # Setup Selenium web driver
         self._load_driver()
 
     def _load_driver(self):
-        # Create the Selenium web driver (no screen necesarry, file access)
-        options = Options()
-        options.headless = True
-        options.add_argument("allow-file-access-from-files")
-        self.driver = webdriver.Chrome(chrome_options=options)
-        self.driver.set_window_size(600, 1600)
+        self.driver = self.pool.acquire()
 
     def retrieve_game_state(self, force=False):
         try:
@@ -140,10 +778,11 @@ class ByYourCommand:
             raise ValueError("Context switched (state)")
 
     def run_page(self, choices, game_state, force=False, quits=False,
-                 quote=True, num=1):
+                 quote=True, num=1, timeout=DIALOG_TIMEOUT):
         """
         Perform action(s) for a user through script dialogs to bring the game
-        to a certain state.
+        to a certain state. Each dialog is waited for at most `timeout`
+        seconds.
         """
 
         # TODO: Think about how to handle cross-play and "undos" that the group 
@@ -155,25 +794,21 @@ class ByYourCommand:
             self.retrieve_game_state(force=force)
             choices = choices[-num:]
         except ValueError:
-            page = f"game/page-{self.game_id}-{unique_hash(self.user)}.html"
-            page_path = Path(page)
-            script_url = self.SCRIPT_PATH.resolve().as_uri()
-            with page_path.open('w') as page_file:
-                page_file.write(f'''<!DOCTYPE html>
+            page = self.server.add_page(self.page_name, f'''<!DOCTYPE html>
                 <html>
                     <head><title>BYC</title></head>
                     <body>
                         <h1>{self.user}</h1>
                         <a href="/collection/user/{self.user}">Collection</a>
                         <textarea>{game_state}</textarea>
-                        <script src="{script_url}"></script>
+                        <script src="/byc.js"></script>
                     </body>
                 </html>''')
 
-            self.driver.get(page_path.resolve().as_uri())
+            self.driver.get(self.server.get_url(page))
 
         try:
-            dialog = Dialog(self._wait_for_dialog())
+            dialog = Dialog(self._wait_for_dialog(timeout=timeout))
         except TimeoutException:
             logging.debug("Browser log (initial timeout): %r",
                           self.driver.get_log("browser"))
@@ -182,7 +817,7 @@ class ByYourCommand:
         # Check for BYC updates
         if self._check_script_update():
             try:
-                dialog = Dialog(self._wait_for_dialog())
+                dialog = Dialog(self._wait_for_dialog(timeout=timeout))
             except TimeoutException:
                 logging.debug("Browser log (timeout after update): %r",
                               self.driver.get_log("browser"))
@@ -191,18 +826,17 @@ class ByYourCommand:
         for index, choice in enumerate(choices):
             logging.info("Handling choice #%d: %s", index, choice.lstrip("\b"))
             if dialog.input and not choice.startswith("\b"): # Non-button input
-                dialog.input.send_keys(choice)
+                dialog.input_element.send_keys(choice)
                 button = dialog.element.find_element_by_class_name("ok")
             else:
-                index = choice.lstrip("\b")
-                button = dialog.button_elements[int(index) - 1]
+                button_index = choice.lstrip("\b")
+                button = dialog.button_elements[int(button_index) - 1]
 
             logging.info("Pressed: %s", button.get_attribute("innerText"))
             button.click()
 
             try:
-                wait = invisibility_of_element(dialog.element)
-                self._wait_for_dialog(wait=wait)
+                self._wait_for_dialog(dialog.element, timeout=timeout)
             except TimeoutException:
                 raise RuntimeError("Dialog did not disappear")
 
@@ -214,7 +848,7 @@ class ByYourCommand:
                 return self._get_game_state(quote=quote)
 
             try:
-                dialog = Dialog(self._wait_for_dialog())
+                dialog = Dialog(self._wait_for_dialog(timeout=timeout))
             except TimeoutException:
                 logging.debug("Browser log (ending timeout): %r",
                               self.driver.get_log("browser"))
@@ -223,10 +857,20 @@ class ByYourCommand:
         logging.debug("Browser log: %r", self.driver.get_log("browser"))
         return dialog
 
-    def _wait_for_dialog(self, wait=None):
-        if wait is None:
-            wait = visibility_of_element_located((By.CLASS_NAME, "dialog"))
-        return WebDriverWait(self.driver, 2).until(wait)
+    def _wait_for_dialog(self, element=None, timeout=DIALOG_TIMEOUT):
+        """
+        Wait until a dialog is shown and return a description of its element,
+        message, buttons and input, or if an element is provided, wait until
+        that dialog is hidden or removed.
+        """
+
+        self.driver.set_script_timeout(timeout + 1)
+        result = self.driver.execute_async_script(self.WAIT_SCRIPT,
+                                                  int(timeout * 1000), element)
+        if not result:
+            raise TimeoutException(f"Dialog wait timed out after {timeout}s")
+
+        return result
 
     def _get_game_state(self, quote=True):
         textarea = self.driver.find_element_by_tag_name("textarea")
@@ -256,48 +900,72 @@ class ByYourCommand:
 
         return {}
 
-    def make_game_seed(self, state):
+    @classmethod
+    def make_game_seed(cls, state):
         return f"[c][size=1][color=#FFFFFF]New seed: {state}[/color][/size][/c]"
 
-    def set_game_seed(self, game_state, seed):
+    @classmethod
+    def set_game_seed(cls, game_state, seed):
         encoded = b64encode(json.dumps(seed).encode()).decode()
         state = "-".join(re.findall(r".{1,20}", encoded))
-        new_seed = self.make_game_seed(state)
-        return self.GAME_SEED_REGEX.sub(new_seed, game_state)
+        new_seed = cls.make_game_seed(state)
+        return cls.GAME_SEED_REGEX.sub(new_seed, game_state)
 
-    def save_game_state_screenshot(self, images, html):
+    def save_game_state_screenshot(self, html, path=None):
         """
         Using HTML parsed from a BYC Game State quote, create a screenshot
-        that displays the current game state.
+        that displays the current game state. The screenshot is cropped to
+        the content of the page in the browser and returned as an in-memory
+        PNG file, which is also written to `path` if provided.
         """
 
-        page_path = Path(f"game/game-state-{self.game_id}-{unique_hash(self.user)}.html")
-        style_url = self.STYLE_PATH.resolve().as_uri()
-        with page_path.open('w') as page_file:
-            page_file.write(f'''<!DOCTYPE html>
+        name = f"game-state-{self.game_id}-{unique_hash(self.user)}"
+        page = self.server.add_page(name, f'''<!DOCTYPE html>
             <html>
                 <head>
                     <title>BYC: Game State</title>
-                    <link rel="stylesheet" type="text/css" href="{style_url}">
+                    <link rel="stylesheet" type="text/css" href="/game_state.css">
                 </head>
                 <body>{html}</body>
             </html>''')
 
-        self.driver.get(page_path.resolve().as_uri())
-        screenshot_path = page_path.with_suffix(".png")
-        self.driver.save_screenshot(str(screenshot_path))
+        try:
+            # Clip the screenshot to the content using the DevTools protocol
+            self.driver.get(self.server.get_url(page))
+            bounds = self.driver.execute_script(self.BOUNDS_SCRIPT,
+                                                self.SCREENSHOT_MARGIN)
+            if bounds:
+                left, top, right, bottom = bounds
+                result = self.driver.execute_cdp_cmd("Page.captureScreenshot", {
+                    "format": "png",
+                    "clip": {
+                        "x": left,
+                        "y": top,
+                        "width": right - left,
+                        "height": bottom - top,
+                        "scale": 1
+                    }
+                })
+                screenshot = b64decode(result["data"])
+            else:
+                screenshot = self.driver.get_screenshot_as_png()
+        finally:
+            self.server.remove_page(name)
 
-        images.crop(screenshot_path)
+        if path is not None:
+            with Path(path).open('wb') as screenshot_file:
+                screenshot_file.write(screenshot)
 
-        return screenshot_path
+        image = BytesIO(screenshot)
+        image.name = f"{name}.png"
+        return image
 
     def _check_script_update(self):
         urgent_script = 'return window.localStorage.getItem("bycUrgent");'
         urgent = self.driver.execute_script(urgent_script)
         if urgent in ("requested", "outdated"):
             logging.info("Updating BYC: %s", urgent)
-            with self.SCRIPT_PATH.open('w') as script_file:
-                script_file.write(self._load_script())
+            self._update_script()
 
             self.driver.execute_script('window.localStorage.removeItem("bycUrgent");')
             self.driver.refresh()
@@ -305,27 +973,87 @@ class ByYourCommand:
 
         return False
 
-    def _load_script(self):
-        # Regular expressions that put together the source code from the page.
-        qre = []
-        for tag in ["A", "B", "C", "D", "E", "F"]:
-            qre.append(re.compile(fr"STARTBYC{tag}(?:(?!(STARTBYC|ENDBYC)).)*ENDBYC{tag}"))
-
-        response = requests.get(self.script_url)
-        response.raise_for_status()
-
-        src = response.text
-        totaljs = ""
-        startchar = 9
-        endchar = -7
-        for part in qre:
-            match = part.search(src)
-            if not match:
-                raise RuntimeError("Could not read script.")
-            totaljs += match.group(0)[startchar:endchar]
+    @classmethod
+    def extract_script(cls, src):
+        """
+        Put together the source code of the script from the parts on the
+        script page in a single scan over the page. A part is the text on
+        one line between STARTBYC and ENDBYC markers with the same tag and
+        without other markers in between, and the first such text is used
+        for each tag.
+        """
 
+        parts = {}
+        markers = list(cls.SCRIPT_MARKER_REGEX.finditer(src))
+        for index, match in enumerate(markers):
+            marker, tag = match.groups()
+            if marker != "START" or tag in parts:
+                continue
+
+            # The next marker may start with the tag character of this one
+            start = match.end() + len(tag)
+            end = next((other for other in markers[index + 1:index + 3]
+                        if other.start() >= start), None)
+            if end is not None and end.groups() == ("END", tag) and \
+                src.find("\n", start, end.start()) == -1:
+                parts[tag] = src[start:end.start()]
+
+        if any(tag not in parts for tag in cls.SCRIPT_PARTS):
+            raise RuntimeError("Could not read script.")
+
+        totaljs = "".join(parts[tag] for tag in cls.SCRIPT_PARTS)
         return totaljs.replace("&gt;", ">").replace("&amp;", "&")
 
+    def _update_script(self):
+        """
+        Download the script page if it changed since the previous download,
+        and replace the script with the version from the page. Versions are
+        stored by their hash, and the script is replaced atomically so that
+        pages never load a partially written script. Returns whether the
+        script changed.
+        """
+
+        with self.script_lock:
+            try:
+                with self.SCRIPT_META_PATH.open('r') as meta_file:
+                    meta = json.load(meta_file)
+            except (IOError, ValueError):
+                meta = {}
+
+            headers = {}
+            if meta.get("url") == self.script_url and self.SCRIPT_PATH.exists():
+                if "etag" in meta:
+                    headers["If-None-Match"] = meta["etag"]
+                if "last_modified" in meta:
+                    headers["If-Modified-Since"] = meta["last_modified"]
+
+            response = requests.get(self.script_url, headers=headers)
+            if response.status_code == 304:
+                logging.info("BYC script page is not modified")
+                return False
+
+            response.raise_for_status()
+            script = self.extract_script(response.text).encode()
+            version = sha1(script).hexdigest()
+            version_path = self.SCRIPT_VERSIONS_PATH / f"{version}.js"
+            if not version_path.exists():
+                self.SCRIPT_VERSIONS_PATH.mkdir(exist_ok=True)
+                write_atomic(version_path, script)
+
+            changed = meta.get("version") != version or \
+                not self.SCRIPT_PATH.exists()
+            if changed:
+                logging.info("Using BYC script version %s", version)
+                write_atomic(self.SCRIPT_PATH, script)
+
+            meta = {"url": self.script_url, "version": version}
+            if "ETag" in response.headers:
+                meta["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                meta["last_modified"] = response.headers["Last-Modified"]
+            write_atomic(self.SCRIPT_META_PATH, json.dumps(meta).encode())
+            return changed
+
     def check_images(self, images, download=False):
         """
         Check and optionally preload images from the BYC script.
@@ -342,20 +1070,16 @@ class ByYourCommand:
             "rebelBasestarImage", "basestarBridgeImage", "newCapricaImage",
             "cylonImage", "CFBImage", "boardImage"
         }
-        seen = set()
+        found = {}
         function_regex = re.compile(r"function (\w+)\([^)]*\) {")
         image_regex = re.compile(r"image[MO]\((\d+)\)|\[ima\" \+ bl \+ \"geid=(\d+)\D", re.I)
         with self.SCRIPT_PATH.open('r') as script_file:
             for script in script_file:
                 for match in image_regex.finditer(script):
-                    for group in match.groups()[1:]:
-                        if group is not None:
-                            image_id = group
-                            break
-
-                    if image_id in seen:
+                    image_id = next(group for group in match.groups()
+                                    if group is not None)
+                    if image_id in found:
                         continue
-                    seen.add(image_id)
 
                     pos = match.start()
                     start = script.rfind("function ", 0, pos)
@@ -367,7 +1091,165 @@ class ByYourCommand:
                         else:
                             function = "(no match)"
 
-                    image = images.retrieve(image_id, download=download)
-                    if image is None and function not in ok_functions:
-                        logging.info("Unknown image ID %s in function %s (%d:%d)",
-                                     image_id, function, start, pos)
+                    found[image_id] = (function, start, pos)
+
+        if download:
+            images.prefetch(found.keys())
+
+        for image_id, (function, start, pos) in found.items():
+            image = images.retrieve(image_id, download=download)
+            if image is None and function not in ok_functions:
+                logging.info("Unknown image ID %s in function %s (%d:%d)",
+                             image_id, function, start, pos)
+
+class RemoteByYourCommand(ByYourCommand):
+    """
+    By Your Command game that is run by a BYC worker process (`byc_worker.py`)
+    instead of the bot process. Requests and responses are JSON objects on
+    single lines over a TCP connection to the worker. Games are spread over
+    the workers by their game ID. When the connection fails before a request
+    is sent, for example because the worker was restarted, the request is
+    sent once more over a new connection, and the worker starts the game
+    anew. Requests are not idempotent, so they are never sent again once
+    they were delivered, even if no response arrived.
+    """
+
+    ERRORS = {
+        "ValueError": ValueError,
+        "BusyError": BusyError,
+        "TimeoutException": TimeoutException
+    }
+    TIMEOUT = 300
+    RETRIES = 1
+
+    addresses = []
+
+    def __init__(self, game_id, user, script_url):
+        self.connection = None
+        self.stream = None
+        super().__init__(game_id, user, script_url)
+
+    @classmethod
+    def use_workers(cls, addresses):
+        """
+        Run games created with `create` in BYC workers at the comma-separated
+        host:port addresses.
+        """
+
+        cls.addresses = []
+        for address in addresses.split(","):
+            host, _, port = address.strip().rpartition(":")
+            cls.addresses.append((host or "127.0.0.1", int(port)))
+
+        ByYourCommand.game_class = cls
+
+    def load(self):
+        self._connect()
+
+    def _connect(self):
+        index = zlib.crc32(str(self.game_id).encode()) % len(self.addresses)
+        address = self.addresses[index]
+        self.connection = socket.create_connection(address,
+                                                   timeout=self.TIMEOUT)
+        self.stream = self.connection.makefile('rwb')
+
+    def _close(self):
+        if self.connection is not None:
+            try:
+                self.stream.close()
+                self.connection.close()
+            except OSError:
+                pass
+
+            self.connection = None
+            self.stream = None
+
+    def _is_closed(self):
+        """
+        Check whether the worker closed the idle connection. The worker only
+        writes responses to requests, so an idle connection that is readable
+        has reached its end or was reset.
+        """
+
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        return bool(readable)
+
+    def _request(self, method, **params):
+        request = json.dumps({
+            "method": method,
+            "game_id": self.game_id,
+            "user": self.user,
+            "script_url": self.script_url,
+            "params": params
+        }).encode()
+        for attempt in range(self.RETRIES + 1):
+            try:
+                if self.connection is not None and self._is_closed():
+                    self._close()
+                if self.connection is None:
+                    self._connect()
+
+                self.stream.write(request + b"\n")
+                self.stream.flush()
+                break
+            except OSError:
+                self._close()
+                if attempt == self.RETRIES:
+                    raise
+
+                logging.warning("Reconnecting to BYC worker for %s",
+                                self.game_id)
+
+        # The worker may have performed the request, so it is not sent again
+        # when the response fails. A late response would be read as that of
+        # the next request, so the connection is closed.
+        try:
+            line = self.stream.readline()
+        except OSError:
+            self._close()
+            raise
+
+        if not line:
+            self._close()
+            raise ConnectionError("BYC worker closed the connection")
+
+        response = json.loads(line)
+        if "error" in response:
+            error = self.ERRORS.get(response["error"]["type"], RuntimeError)
+            raise error(response["error"]["message"])
+
+        return response["result"]
+
+    def stop(self):
+        if self.connection is not None:
+            try:
+                self._request("stop")
+            except (OSError, RuntimeError):
+                logging.exception("Could not stop BYC game in worker")
+
+            self._close()
+
+    def retrieve_game_state(self, force=False):
+        return self._request("retrieve_game_state", force=force)
+
+    def run_page(self, choices, game_state, force=False, quits=False,
+                 quote=True, num=1, timeout=ByYourCommand.DIALOG_TIMEOUT):
+        result = self._request("run_page", choices=choices,
+                               game_state=game_state, force=force,
+                               quits=quits, quote=quote, num=num,
+                               timeout=timeout)
+        if "dialog" in result:
+            return Dialog(dict(result["dialog"], element=None))
+
+        return result["game_state"]
+
+    def save_game_state_screenshot(self, html, path=None):
+        result = self._request("screenshot", html=html)
+        screenshot = b64decode(result["data"])
+        if path is not None:
+            with Path(path).open('wb') as screenshot_file:
+                screenshot_file.write(screenshot)
+
+        image = BytesIO(screenshot)
+        image.name = result["name"]
+        return image
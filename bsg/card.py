@@ -1,9 +1,11 @@
 from collections import OrderedDict
 import json
 import logging
+from pathlib import Path
 import re
-import yaml
-from .search import Card
+from .data import Data
+from .files import write_atomic
+from .search import Card, SearchCache
 
 class Cards:
     TEXT_PARSERS = {
@@ -37,11 +39,16 @@ class Cards:
         "discord": "\\*"
     }
 
+    NAMES_PATH = Path("data/_names.json")
+
     loaded = False
 
     @classmethod
     def load(cls):
         if cls.loaded:
+            if cls.generation != SearchCache.get_generation():
+                cls.load_names()
+
             return cls
 
         cls.loaded = True
@@ -53,63 +60,141 @@ class Cards:
         cls.loyalty = {}
         cls.activations = {}
 
-        cls._skill_colors = None
-        cls._deck_cards = None
-
-        with open("data/_meta.yml") as data_file:
-            data = yaml.safe_load(data_file)
-            cls.expansions = data['expansions']
-            cls.decks = data['decks']
-            cls.skills = data['skills']
-            cls.character_classes = data['character_classes']
-            cls.titles = data['titles']
-            cls.loyalty = data['loyalty']
-            cls.activations = data['activations']
+        data = Data.load("data/_meta.yml")[0]
+        cls.expansions = data['expansions']
+        cls.decks = data['decks']
+        cls.skills = data['skills']
+        cls.character_classes = data['character_classes']
+        cls.titles = data['titles']
+        cls.loyalty = data['loyalty']
+        cls.activations = data['activations']
+
+        cls._title_regexes = dict([
+            (key, re.compile(rf"\b{key}\b(?!['-])"))
+            for key in cls.titles.keys()
+        ])
+        cls.load_names()
 
         return cls
 
+    @classmethod
+    def build_names(cls):
+        """
+        Collect the names of the skill cards of each skill type and the card
+        names of each deck that is denoted in card mentions from the data
+        files.
+        """
+
+        skill_cards = {skill_type: [] for skill_type in cls.skills.keys()}
+        deck_names = {
+            deck: [] for deck, data in cls.decks.items()
+            if data.get('denote', True)
+        }
+        for _, card in Card.from_data():
+            if card.deck in deck_names:
+                deck_names[card.deck].append(card.name)
+            if card.deck == "skill":
+                for skill_type, names in skill_cards.items():
+                    if skill_type.lower() in (skill.lower() for skill in card.skills):
+                        names.append(card.name)
+
+        return {"skills": skill_cards, "decks": deck_names}
+
+    @classmethod
+    def write_names(cls):
+        """
+        Write the table of skill card and deck card names, so that processes
+        can compile the card mention regular expressions at startup without
+        scanning the index.
+        """
+
+        names = cls.build_names()
+        write_atomic(cls.NAMES_PATH, json.dumps(names, indent=1))
+
+    @classmethod
+    def load_names(cls):
+        """
+        Load the table of skill card and deck card names written by the import
+        and compile the regular expressions for card mentions.
+        """
+
+        cls.generation = SearchCache.get_generation()
+        try:
+            with cls.NAMES_PATH.open('r') as names_file:
+                names = json.load(names_file)
+        except (IOError, ValueError):
+            logging.warning("Could not load %s, collecting names from data",
+                            cls.NAMES_PATH)
+            names = cls.build_names()
+
+        cls._skill_cards = names["skills"]
+        cls._deck_names = names["decks"]
+        cls._skill_colors = dict([
+            (skill_type, cls._build_skill_regex(skill_type, skill_cards))
+            for skill_type, skill_cards in cls._skill_cards.items()
+        ])
+        cls._deck_cards = dict([
+            (deck, re.compile('(' + cls._build_regex(deck_names) + ')'))
+            for deck, deck_names in cls._deck_names.items()
+        ])
+
+        mentions = set(cls.skills.keys()) | set(cls.titles.keys())
+        for skill_cards in cls._skill_cards.values():
+            mentions.update(skill_cards)
+        for deck_names in cls._deck_names.values():
+            mentions.update(deck_names)
+
+        cls._mentions = re.compile(cls._build_regex(
+            sorted(mentions, key=lambda name: (-len(name), name))
+        ))
+        cls._replacements = {}
+
     def __init__(self, url):
         self.url = url
         self.load()
 
     @property
-    def skill_colors(self):
-        if self.__class__._skill_colors is None:
-            self.__class__._skill_colors = dict([
-                (skill_type, self._build_skill_regex(skill_type))
-                for skill_type in self.skills.keys()
-            ])
+    def skill_cards(self):
+        return self._skill_cards
+
+    @property
+    def deck_names(self):
+        return self._deck_names
 
+    @property
+    def skill_colors(self):
         return self._skill_colors
 
     @property
     def deck_cards(self):
-        if self.__class__._deck_cards is None:
-            self.__class__._deck_cards = dict([
-                (deck, re.compile('(' + self._build_deck_regex(deck) + ')'))
-                for deck, data in self.decks.items() if data.get('denote', True)
-            ])
-
         return self._deck_cards
 
+    @property
+    def title_regexes(self):
+        return self._title_regexes
+
+    @property
+    def mentions(self):
+        """
+        Regular expression that matches any skill type, skill card, title or
+        card name of a denoted deck, preferring the longest name.
+        """
+
+        return self._mentions
+
     @staticmethod
     def _build_regex(options):
         return '|'.join(re.escape(card) for card in options)
 
-    def _build_skill_regex(self, skill_type):
-        search = Card.search(using='main').filter("term", deck="skill") \
-            .filter("term", skills=skill_type.lower())
-        skill_cards = self._build_regex(card.name for card in search.scan())
+    @classmethod
+    def _build_skill_regex(cls, skill_type, names):
+        skill_cards = cls._build_regex(names)
         logging.info('%s %s', skill_type, skill_cards)
         if skill_cards == '':
             return re.compile(fr'\b({skill_type})\b')
 
         return re.compile(fr'\b({skill_type}|{skill_cards})\b')
 
-    def _build_deck_regex(self, deck):
-        search = Card.search(using='main').filter("term", deck=deck)
-        return self._build_regex(card.name for card in search.scan())
-
     def get_url(self, card):
         url = card.get('url')
         if url is not None:
@@ -301,13 +386,40 @@ class Cards:
         return msg
 
     def replace_cards(self, message, display='discord', deck=True):
+        """
+        Add emoji to skill types, skill cards and titles and add deck names to
+        card names in the message, in one pass over the message. The
+        replacement of each mention is determined from the name and its
+        surrounding characters by the passes of `_replace_passes`, which is
+        only done once for each combination.
+        """
+
+        if display == '' and not deck:
+            return message
+
+        replacements = self._replacements.setdefault((display, deck), {})
+
+        def replace(match):
+            start, end = match.span()
+            key = (message[start - 1:start], match.group(0), message[end:end + 1])
+            if key not in replacements:
+                left, name, right = key
+                text = self._replace_passes(f"{left}{name}{right}", display,
+                                            deck)
+                replacements[key] = text[len(left):len(text) - len(right)]
+
+            return replacements[key]
+
+        return self.mentions.sub(replace, message)
+
+    def _replace_passes(self, message, display='discord', deck=True):
         if display != '':
             for skill_type, skill_regex in self.skill_colors.items():
                 emoji = self.skills[skill_type][display]
                 message = skill_regex.sub(fr"\1{emoji}", message)
-            for key, title in self.titles.items():
-                message = re.sub(rf"\b{key}\b(?!['-])",
-                                 f"{key}{title[display]}", message)
+            for key, title_regex in self.title_regexes.items():
+                title = self.titles[key]
+                message = title_regex.sub(f"{key}{title[display]}", message)
 
         if deck:
             for deck, card_regex in self.deck_cards.items():
@@ -361,10 +473,7 @@ class Cards:
 
     def lines_of_succession(self, seed, unquote=True):
         players = seed.get("players", [])
-        search = Card.search(using='main') \
-            .filter("term", deck="char") \
-            .filter("terms", path__raw=players)
-        chars = list(search.scan())
+        chars = list(Card.find(deck="char", path__raw=players))
             
         cylons = {
             player: cylon
@@ -411,12 +520,11 @@ class Cards:
                 continue
 
             indexes = seed[data['seed']][:-data['analyze']-1:-1]
-            search = Card.search(using='main') \
-                .filter("term", deck=deck) \
-                .filter("terms", index=list(range(0, max(indexes) + 1)))
+            search = Card.find(deck=deck,
+                               index=list(range(0, max(indexes) + 1)))
 
             lookup = {}
-            for card in search.scan():
+            for card in search:
                 if deck == "skill" and "Treachery" in card.skills and \
                     ((card.expansion == "pegasus" and seed.get('daybreak')) or \
                     (card.expansion == "daybreak" and not seed.get('daybreak'))):
@@ -0,0 +1,203 @@
+"""
+Asynchronous HTTP client for APIs and downloads.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+import random
+from tempfile import NamedTemporaryFile
+from threading import Lock, Thread
+import aiohttp
+
+class HttpError(Exception):
+    """
+    Error that indicates that an HTTP request failed, either because of a
+    connection problem, a timeout or an unsuccessful status code.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class Response:
+    """
+    Completely read response to an HTTP request.
+    """
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def text(self):
+        return self.body.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HttpError(f"HTTP status {self.status} for {self.url}",
+                            status=self.status)
+
+class HttpClient:
+    """
+    HTTP client that performs requests on an event loop in a separate thread,
+    such that a pool of connections is shared by all callers. Requests can be
+    awaited from any event loop, or made synchronously from other threads.
+    The number of concurrent connections to each host is limited. Requests
+    that fail because of connection problems, timeouts, rate limiting or
+    server errors are retried with an exponential backoff and random jitter.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, limit=32, limit_per_host=4, timeout=30, retries=3,
+                 backoff=0.5, max_backoff=30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.loop = None
+        self.session = None
+        self.lock = Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                thread = Thread(target=loop.run_forever, name="http-client",
+                                daemon=True)
+                thread.start()
+                self.loop = loop
+
+            return self.loop
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._start())
+
+    async def _call(self, coro):
+        return await asyncio.wrap_future(self._submit(coro))
+
+    def run(self, coro):
+        """
+        Synchronously run a coroutine in the event loop of the client and
+        return its result. This must not be called from that event loop.
+        """
+
+        return self._submit(coro).result()
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host)
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=timeout)
+
+        return self.session
+
+    def _get_delay(self, attempt, headers=None):
+        if headers is not None and "Retry-After" in headers:
+            try:
+                return min(float(headers["Retry-After"]), self.max_backoff)
+            except ValueError:
+                pass
+
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return random.uniform(delay / 2, delay)
+
+    async def _request(self, method, url, path=None, **kw):
+        session = self._get_session()
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with session.request(method, url, **kw) as response:
+                    if response.status in self.RETRY_STATUSES and not last:
+                        delay = self._get_delay(attempt, response.headers)
+                        logging.info("HTTP status %d for %s, retrying in %.1fs",
+                                     response.status, url, delay)
+                        await asyncio.sleep(delay)
+                        continue
+
+                    if path is None or response.status >= 400:
+                        body = await response.read()
+                    else:
+                        body = b""
+                        await self._write(response, path)
+
+                    return Response(str(response.url), response.status,
+                                    dict(response.headers), body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if last:
+                    raise HttpError(f"Request to {url} failed: {error!r}")
+
+                delay = self._get_delay(attempt)
+                logging.info("Request to %s failed (%r), retrying in %.1fs",
+                             url, error, delay)
+                await asyncio.sleep(delay)
+
+        raise HttpError(f"Request to {url} failed")
+
+    @staticmethod
+    async def _write(response, path):
+        # Concurrent downloads to the same path each write their own file,
+        # which is removed if the download fails
+        temp_file = NamedTemporaryFile(dir=str(path.parent),
+                                       prefix=f".{path.name}.", delete=False)
+        try:
+            with temp_file:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    temp_file.write(chunk)
+
+            os.replace(temp_file.name, str(path))
+        except BaseException:
+            try:
+                os.unlink(temp_file.name)
+            except FileNotFoundError:
+                pass
+
+            raise
+
+    async def get(self, url, params=None, headers=None):
+        """
+        Perform a GET request and return the `Response`.
+        """
+
+        return await self._call(self._request("GET", url, params=params,
+                                              headers=headers))
+
+    async def download(self, url, path):
+        """
+        Download a file from a URL to the path. Returns the `Response`, whose
+        body is empty if the download succeeded.
+        """
+
+        return await self._call(self._request("GET", url, path=Path(path)))
+
+    async def _close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def close(self):
+        """
+        Close the connections of the client and stop its event loop.
+        """
+
+        with self.lock:
+            loop = self.loop
+            self.loop = None
+
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self._close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+
+shared_client = HttpClient()
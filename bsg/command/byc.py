@@ -1,4 +1,5 @@
-from contextlib import contextmanager
+from collections import Counter
+from contextlib import asynccontextmanager
 from datetime import datetime
 from glob import glob
 from itertools import chain, zip_longest
@@ -9,7 +10,7 @@ import re
 import shutil
 from .base import Command
 from ..bbcode import BBCodeMarkdown
-from ..byc import ByYourCommand, Dialog, ROLE_TEXT
+from ..byc import BusyError, ByYourCommand, Dialog, ROLE_TEXT
 from ..card import Cards
 from ..image import Images
 from ..search import Card, Location
@@ -26,6 +27,7 @@ def format_username(user, replacement="-"):
 
 class BycCommand(Command):
     byc_games = {}
+    byc_users = Counter()
 
     def __init__(self, name, context):
         super().__init__(name, context)
@@ -36,19 +38,49 @@ class BycCommand(Command):
         self.game_state = ""
         self.game_id = None
 
-    @contextmanager
-    def get_byc(self, keep=None):
-        key = f"{self.game_id}-{self.context.user}"
-        if key not in self.byc_games:
-            byc = ByYourCommand(self.game_id, self.context.user,
-                                self.context.config['script_url'])
-            self.byc_games[key] = byc
+    async def run_byc(self, function, *args, **kw):
+        """
+        Perform blocking BYC work in a worker for the game.
+        """
+
+        return await ByYourCommand.workers.run(self.game_id, function,
+                                               *args, **kw)
 
+    @asynccontextmanager
+    async def get_byc(self, keep=None):
+        key = f"{self.game_id}-{self.context.user}"
+        byc = self.byc_games.get(key)
+        duplicate = None
+        if byc is None:
+            created = await self.run_byc(ByYourCommand.create, self.game_id,
+                                         self.context.user,
+                                         self.context.config['script_url'])
+            byc = self.byc_games.setdefault(key, created)
+            if byc is not created:
+                duplicate = created
+
+        # Count the commands using the game so that it is only stopped once
+        # the last of them is done with it
+        self.byc_users[key] += 1
         try:
-            yield self.byc_games[key]
+            if duplicate is not None:
+                await self.stop_byc(duplicate)
+
+            yield byc
         finally:
-            if keep is None or not keep():
-                self.byc_games.pop(key, None)
+            self.byc_users[key] -= 1
+            if self.byc_users[key] <= 0:
+                del self.byc_users[key]
+                if (keep is None or not keep()) and \
+                    self.byc_games.get(key) is byc:
+                    del self.byc_games[key]
+                    await self.stop_byc(byc)
+
+    async def stop_byc(self, byc):
+        try:
+            await ByYourCommand.workers.finish(self.game_id, byc.stop)
+        except Exception:
+            logging.exception("Could not stop BYC game %s", self.game_id)
 
     def format_button(self, button, text):
         if text == "Save and Quit":
@@ -92,12 +124,10 @@ class BycCommand(Command):
                 role = None
             elif character not in roles:
                 # Search in cards what the class is and use metadata for color
-                search = Card.search(using='main').source(['character_class']) \
-                    .filter("term", deck="char").query("match", path=character)
+                search = Card.find(deck="char", path__raw=character)
                 try:
-                    card = search[:1].execute().hits[0]
-                    class_name = card.character_class
-                except IndexError:
+                    class_name = next(iter(search)).character_class
+                except StopIteration:
                     logging.exception("Could not find character %s", character)
                     continue
 
@@ -246,22 +276,37 @@ class BycCommand(Command):
         if force == False:
             return
 
-        # Now do the actual BYC execution
+        try:
+            await self.play(choices, game_state, force, is_main_channel,
+                            user_channel)
+        except BusyError:
+            await self.context.send("The BYC game is busy with other actions, "
+                                    "please try again in a moment.")
+
+    async def play(self, choices, game_state, force, is_main_channel,
+                   user_channel):
+        """
+        Perform the actual BYC execution of the choices and report the next
+        dialog or the resulting game state.
+        """
+
         query = False
-        with self.get_byc(keep=lambda: query) as byc:
+        async with self.get_byc(keep=lambda: query) as byc:
             if not self.initial_setup:
                 # Try to avoid reading files all the time and use the browser's
                 # current game state instead
                 try:
-                    game_state = byc.retrieve_game_state(force=force)
+                    game_state = await self.run_byc(byc.retrieve_game_state,
+                                                    force=force)
                 except ValueError:
                     with self.game_state_path.open('r') as game_state_file:
                         game_state = game_state_file.read()
 
             run = True
             while run:
-                dialog = byc.run_page(choices[2:] if self.initial_setup else choices,
-                                      game_state, force=force)
+                dialog = await self.run_byc(byc.run_page,
+                                            choices[2:] if self.initial_setup else choices,
+                                            game_state, force=force)
 
                 # Check if we got another dialog
                 query = isinstance(dialog, Dialog)
@@ -422,8 +467,32 @@ class BycCommand(Command):
 
         return reply, run
 
-    async def public_result(self, byc, game_state="", old_game_state=""):
-        seed = byc.get_game_seed(game_state)
+    async def render_game_state(self, game_state, byc=None):
+        """
+        Retrieve a screenshot of the HTML game state that the BBCode processor
+        extracted from the game state. Only if the render cache has no
+        screenshot of the game state, it is rendered by the BYC game `byc`,
+        or by the game of the user if it is `None`.
+        """
+
+        key = ByYourCommand.renders.get_key(self.game_id, game_state)
+        image = ByYourCommand.renders.get(key)
+        if image is not None:
+            return image
+
+        if byc is None:
+            async with self.get_byc() as byc:
+                image = await self.run_byc(byc.save_game_state_screenshot,
+                                           self.bbcode.game_state)
+        else:
+            image = await self.run_byc(byc.save_game_state_screenshot,
+                                       self.bbcode.game_state)
+
+        ByYourCommand.renders.put(key, image)
+        return image
+
+    async def public_result(self, byc=None, game_state="", old_game_state=""):
+        seed = ByYourCommand.get_game_seed(game_state)
         users = self.initial_setup
         updated = False
         old_seed = {}
@@ -433,7 +502,7 @@ class BycCommand(Command):
         for role_group, texts in ROLE_TEXT.items():
             role_texts[role_group] = any(text in game_state for text in texts)
             if role_texts[role_group] and old_seed is None:
-                old_seed = byc.get_game_seed(old_game_state)
+                old_seed = ByYourCommand.get_game_seed(old_game_state)
                 roles = {role.name: role for role in self.context.roles}
 
         if role_texts["character"]:
@@ -454,26 +523,26 @@ class BycCommand(Command):
             seed["promptStyle"] = [1] * len(seed["players"])
             updated = True
         if updated:
-            game_state = byc.set_game_seed(game_state, seed)
+            game_state = ByYourCommand.set_game_seed(game_state, seed)
 
         if self.game_state_path is not None:
             if "round" in seed:
-                backup = f'game/game-{self.game_id}-{seed["round"]}-{seed["turn"]}-{datetime.now()}-{format_username(byc.user, "_")}.txt'
+                backup = f'game/game-{self.game_id}-{seed["round"]}-{seed["turn"]}-{datetime.now()}-{format_username(self.context.user, "_")}.txt'
                 shutil.copy(str(self.game_state_path), backup)
 
             with self.game_state_path.open('w') as game_state_file:
                 game_state_file.write(game_state)
 
         # Process the game state (BBCode -> Markdown and HTML game state)
-        game_state_markdown = self.bbcode.process_bbcode(game_state)
+        game_state_markdown = await self.run_byc(self.bbcode.process_bbcode,
+                                                 game_state)
         message, mentions = self.context.replace_roles(game_state_markdown,
                                                        cards=self.cards,
                                                        seed=seed, users=users,
                                                        deck=False)
 
         if self.bbcode.game_state != "":
-            image = byc.save_game_state_screenshot(self.images,
-                                                   self.bbcode.game_state)
+            image = await self.render_game_state(game_state, byc=byc)
         else:
             image = None
 
@@ -665,16 +734,14 @@ class BackupCommand(BycCommand):
             await channel.send(f'Going back {label}...')
             with self.game_state_path.open('r') as game_state_file:
                 game_state = game_state_file.read()
-                with self.get_byc() as byc:
-                    await self.public_result(byc, game_state=game_state)
+                await self.public_result(game_state=game_state)
 
             return
 
         # Display options, including latest game seed data
         with self.game_state_path.open('r') as game_state_file:
             game_state = game_state_file.read()
-            with self.get_byc() as byc:
-                game_seed = byc.get_game_seed(game_state)
+            game_seed = ByYourCommand.get_game_seed(game_state)
 
             match = re.match(r'\[q="([^"]*)"\]', game_state)
             if match:
@@ -774,7 +841,7 @@ class CleanupCommand(BycCommand):
         # Cleanup roles of users involved in the game
         with self.game_state_path.open('r') as game_state_file:
             game_state = game_state_file.read()
-            with self.get_byc() as byc:
+            async with self.get_byc() as byc:
                 game_seed = byc.get_game_seed(game_state)
 
         roles = {role.name: role for role in self.context.roles}
@@ -801,8 +868,13 @@ class CleanupCommand(BycCommand):
             Path(path).unlink()
         for path in glob(f"game/game-state-{self.game_id}-*"):
             Path(path).unlink()
-        for path in glob(f"game/page-{self.game_id}-*.html"):
-            Path(path).unlink()
+        # Games still in use by other commands are stopped when they are done
+        for key in [key for key in self.byc_games
+                    if key.startswith(f"{self.game_id}-") and
+                    key not in self.byc_users]:
+            byc = self.byc_games.pop(key, None)
+            if byc is not None:
+                await self.stop_byc(byc)
 
 @Command.register("refresh", slow=True,
                   enabled=lambda context: context.byc_enabled,
@@ -824,12 +896,33 @@ class RefreshCommand(BycCommand):
         priorities = {
             name: title.get("priority", 99) for name, title in iterator
         }
-        search = Card.search(using='main').source(['path']) \
-            .filter("term", deck="char")
-        priorities.update({char.path: 99 for char in search.scan()})
+        priorities.update({
+            char.path: 99 for char in Card.find(deck="char")
+        })
         sorted_roles = sorted(roles.items(),
                               key=lambda item: priorities.get(item[0], -1))
         logging.info('%r', sorted_roles)
         for i, (name, role) in enumerate(reversed(sorted_roles)):
             if name in priorities:
                 await role.edit(position=i + 1)
+
+@Command.register("workers")
+class WorkersCommand(Command):
+    """
+    Command to show statistics of the BYC game workers.
+    """
+
+    async def run(self, **kw):
+        stats = ByYourCommand.workers.get_stats()
+        depths = ", ".join(
+            f"{game_id}: {depth}" for game_id, depth in stats["depths"].items()
+        )
+        await self.context.send(
+            f"{stats['pending']} pending BYC actions"
+            f"{f' ({depths})' if depths else ''}, "
+            f"{stats.get('submitted', 0)} submitted, "
+            f"{stats.get('completed', 0)} completed, "
+            f"{stats.get('failed', 0)} failed, "
+            f"{stats.get('rejected', 0)} rejected, "
+            f"maximum queue depth {stats.get('max_depth', 0)}"
+        )
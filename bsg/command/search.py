@@ -8,8 +8,8 @@ from expression import Expression_Parser
 from .base import Command
 from ..card import Cards
 from ..image import Images
-from ..search import Card, Location
-from ..thread import Thread
+from ..search import Card, Location, SearchMixin
+from ..thread import Thread, ThreadPoller
 
 class SearchCommand(Command):
     DEFAULT_LIMIT = 3
@@ -79,9 +79,14 @@ class SearchCommand(Command):
             # Check if the seed constraints may hide this result
             if hit.seed:
                 if seed is None:
-                    thread = Thread(self.context.config['api_url'])
-                    seed = thread.retrieve(self.context.config['thread_id'],
-                                           download=False)[1]
+                    thread_id = self.context.config['thread_id']
+                    latest = ThreadPoller.get(thread_id)
+                    if latest is not None:
+                        seed = latest["seed"]
+                    else:
+                        thread = Thread(self.context.config['api_url'])
+                        seed = (await thread.retrieve(thread_id,
+                                                      download=False))[1]
 
                 # Seed may not be locally available at this point
                 if seed is not None:
@@ -142,11 +147,17 @@ class SearchCommand(Command):
             if not image.exists():
                 if not path.exists():
                     if hit.image:
-                        path = self.images.retrieve(hit.image)
+                        path = await self.images.retrieve_async(hit.image)
+                        if isinstance(path, PurePath) and not path.exists():
+                            # The file was removed outside of the image store
+                            self.images.store.discard(hit.image)
+                            path = await self.images.retrieve_async(hit.image)
                         if not isinstance(path, PurePath):
                             raise ValueError(f'Could not retrieve image {hit.image}')
                     else:
-                        path = self.images.download(url, filename)
+                        path = await self.images.download_async(url, filename)
+                        if path is None:
+                            raise ValueError(f'Could not download image {url}')
 
                 if hit.bbox:
                     try:
@@ -233,3 +244,20 @@ class LocationCommand(SearchCommand):
             return filename, path, image
 
         return filename, path, path
+
+@Command.register("cache")
+class CacheCommand(Command):
+    """
+    Command to show statistics of the search result cache.
+    """
+
+    async def run(self, **kw):
+        stats = SearchMixin.cache.get_stats()
+        await self.context.send(
+            f"{stats['entries']}/{stats['size']} cached searches, "
+            f"{stats.get('hits', 0)} hits, {stats.get('misses', 0)} misses "
+            f"({stats['hit_rate']:.1%} hit rate), "
+            f"{stats.get('evictions', 0)} evictions, "
+            f"{stats.get('expirations', 0)} expirations, "
+            f"{stats.get('invalidations', 0)} invalidations"
+        )
@@ -2,12 +2,14 @@
 Commands that make use of game state from a BGG thread.
 """
 
+import asyncio
+import time
 from .base import Command
 from ..bbcode import BBCodeMarkdown
 from ..byc import ByYourCommand, ROLE_TEXT
 from ..card import Cards
 from ..image import Images
-from ..thread import Thread
+from ..thread import Thread, ThreadPoller
 
 class GameStateCommand(Command):
     """
@@ -23,7 +25,14 @@ class GameStateCommand(Command):
         self.bbcode = BBCodeMarkdown(self.images)
 
     async def run(self, **kw):
-        post, seed = self.thread.retrieve(self.game_id)
+        ThreadPoller.wake(self.game_id)
+        latest = ThreadPoller.get(self.game_id)
+        if latest is None or \
+                time.time() - latest["checked"] >= Thread.max_age:
+            post, seed = await self.thread.retrieve(self.game_id)
+        else:
+            post, seed = latest["post"], latest["seed"]
+
         if post is None:
             self.context.send('No latest post found!')
             return
@@ -33,6 +42,21 @@ class GameStateCommand(Command):
     async def analyze(self, post, seed, **kw):
         raise NotImplementedError("Must be implemented by subclasses")
 
+    async def process_post(self, post):
+        """
+        Process the BBCode of a post, reusing the processed text and parse
+        results of the poller if it is the latest post of the thread.
+        """
+
+        latest = ThreadPoller.get(self.game_id)
+        if latest is not None and latest["post"] == post:
+            self.bbcode.set_state(latest["bbcode"])
+            return latest["text"]
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.bbcode.process_bbcode,
+                                          post)
+
 @Command.register("succession", slow=True,
                   description="Show the line of succession")
 class SuccessionCommand(GameStateCommand):
@@ -58,28 +82,37 @@ class AnalyzeCommand(GameStateCommand):
                   description="Show the lastest game board state")
 class ImageCommand(GameStateCommand):
     async def analyze(self, post, seed, **kw):
-        author = self.thread.get_author(ByYourCommand.get_quote_author(post)[0])
-        byc = ByYourCommand(self.game_id, author,
-                            self.context.config['script_url'])
+        key = ByYourCommand.renders.get_key(self.game_id, post)
+        cached = ByYourCommand.renders.get(key)
+        if cached is not None:
+            await self.context.send("", file=cached)
+            return
+
+        author = await self.thread.get_author(ByYourCommand.get_quote_author(post)[0])
+        image = await ByYourCommand.workers.run(self.game_id, self.screenshot,
+                                                author, post)
+        ByYourCommand.renders.put(key, image)
+        await self.context.send("", file=image)
 
-        choices = []
-        dialog = byc.run_page(choices, post)
-        if "You are not recognized as a player" in dialog.msg:
-            choices.extend(["\b1", "1"])
-        choices.extend(["2", "\b2", "\b0"])
-        post = byc.run_page(choices, post, num=len(choices),
-                            quits=True, quote=False)
+    def screenshot(self, author, post):
+        with ByYourCommand.create(self.game_id, author,
+                                  self.context.config['script_url']) as byc:
+            choices = []
+            dialog = byc.run_page(choices, post)
+            if "You are not recognized as a player" in dialog.msg:
+                choices.extend(["\b1", "1"])
+            choices.extend(["2", "\b2", "\b0"])
+            post = byc.run_page(choices, post, num=len(choices),
+                                quits=True, quote=False)
 
-        text = self.bbcode.process_bbcode(post)
+            text = self.bbcode.process_bbcode(post)
 
-        path = byc.save_game_state_screenshot(self.images,
-                                              self.bbcode.game_state)
-        await self.context.send("", file=path)
+            return byc.save_game_state_screenshot(self.bbcode.game_state)
 
 @Command.register("latest", slow=True, description="Show the latest game post")
 class LatestCommand(GameStateCommand):
     async def analyze(self, post, seed, **kw):
-        text = self.bbcode.process_bbcode(post)
+        text = await self.process_post(post)
 
         users = any(user in text for user in ROLE_TEXT["character"])
         response, mentions = self.context.replace_roles(text, seed=seed,
@@ -91,8 +124,8 @@ class LatestCommand(GameStateCommand):
                   description="Show who needs to do something")
 class PingCommand(GameStateCommand):
     async def analyze(self, post, seed, **kw):
-        author = self.thread.get_author(ByYourCommand.get_quote_author(post)[0])
-        text = self.bbcode.process_bbcode(post)
+        author = await self.thread.get_author(ByYourCommand.get_quote_author(post)[0])
+        text = await self.process_post(post)
 
         users = any(user in text for user in ROLE_TEXT["character"])
         response, mentions = self.context.replace_roles(text, seed=seed,
@@ -3,6 +3,10 @@ from pathlib import Path
 import re
 from requests.models import PreparedRequest
 import yaml
+from .byc import ByYourCommand, RemoteByYourCommand
+from .image import Images
+from .search import SearchMixin
+from .thread import Thread
 
 _url_pattern = re.compile(r"^https?://")
 def validate_url(value):
@@ -52,6 +56,26 @@ class Config(MutableMapping):
         with self.path.open('w') as config_file:
             yaml.dump(self.config, config_file)
 
+    def apply(self, remote=True):
+        """
+        Configure the search backend, thread follower, image store and BYC
+        games from the settings. BYC games are run in the BYC workers from
+        the settings unless `remote` is disabled, such as in those workers.
+        """
+
+        SearchMixin.use_backend(self.get('search_backend', 'elasticsearch'),
+                                cache_size=int(self.get('search_cache_size', 256)),
+                                cache_ttl=int(self.get('search_cache_ttl', 3600)))
+        Thread.max_age = int(self.get('thread_max_age', 0))
+        Images.store.shards = int(self.get('image_shards', 0))
+        Images.store.max_size = int(self.get('image_cache_size', 0)) * 2**20
+        if remote and 'byc_worker' in self:
+            RemoteByYourCommand.use_workers(self['byc_worker'])
+        ByYourCommand.pool.size = int(self.get('driver_pool_size', 1))
+        ByYourCommand.renders.size = int(self.get('render_cache_size', 16))
+        ByYourCommand.workers.max_workers = int(self.get('byc_workers', 4))
+        ByYourCommand.workers.max_pending = int(self.get('byc_queue_limit', 8))
+
 class ServerConfig(MutableMapping):
     def __init__(self, config, server=None):
         self.config = config
@@ -3,6 +3,7 @@ Command context.
 """
 
 import logging
+from pathlib import Path
 import re
 import discord
 from .byc import Dialog
@@ -172,6 +173,13 @@ class CommandLineContext(Context):
     async def send(self, message, file=None, **kw):
         print(message)
         if file is not None:
+            if hasattr(file, "getvalue"):
+                # Write in-memory files such as screenshots to the game path
+                path = Path("game") / file.name
+                with path.open('wb') as output_file:
+                    output_file.write(file.getvalue())
+                file = path
+
             print(f"Associated file can be found in {file}")
 
         return []
@@ -0,0 +1,119 @@
+"""
+Compiled cache of the YAML data files.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import json
+import logging
+import os
+from pathlib import Path
+import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+from .files import write_atomic
+
+class Data:
+    """
+    Snapshot of parsed YAML files. The documents of each file are stored as
+    JSON along with the modification time and size of the file, so that
+    processes only need to parse YAML files that changed since the snapshot
+    was compiled.
+    """
+
+    CACHE_PATH = Path("data/_compiled.json")
+
+    _files = None
+
+    @staticmethod
+    def parse(filename):
+        """
+        Parse all the documents in a YAML file.
+        """
+
+        with open(filename, "r") as data_file:
+            return list(yaml.load_all(data_file, Loader=SafeLoader))
+
+    @staticmethod
+    def _get_key(filename):
+        stat = os.stat(filename)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @classmethod
+    def get_sources(cls, pattern="data/*.yml"):
+        """
+        Retrieve the modification times and sizes of the YAML files matching
+        the pattern, which change when a file is edited, added or removed.
+        """
+
+        sources = []
+        for filename in sorted(glob(pattern)):
+            try:
+                sources.append((filename, *cls._get_key(filename)))
+            except OSError:
+                continue
+
+        return tuple(sources)
+
+    @classmethod
+    def _load_cache(cls):
+        if cls._files is not None:
+            return
+
+        try:
+            with cls.CACHE_PATH.open('r') as cache_file:
+                cls._files = json.load(cache_file)
+        except (IOError, ValueError):
+            cls._files = {}
+
+    @classmethod
+    def _write_cache(cls):
+        try:
+            write_atomic(cls.CACHE_PATH,
+                         json.dumps(cls._files, separators=(',', ':')))
+        except IOError:
+            logging.exception("Could not write compiled data cache")
+
+    @classmethod
+    def compile(cls, filenames):
+        """
+        Parse the YAML files that changed since the snapshot was compiled, in
+        parallel processes if there are multiple such files, and write the
+        snapshot.
+        """
+
+        cls._load_cache()
+        keys = {filename: cls._get_key(filename) for filename in filenames}
+        stale = [
+            filename for filename in filenames
+            if cls._files.get(filename, {}).get("key") != keys[filename]
+        ]
+        if not stale:
+            return
+
+        logging.info("Compiling %s", ", ".join(stale))
+        if len(stale) == 1:
+            documents = [cls.parse(stale[0])]
+        else:
+            with ProcessPoolExecutor() as executor:
+                documents = list(executor.map(cls.parse, stale))
+
+        for filename, docs in zip(stale, documents):
+            cls._files[filename] = {
+                "key": keys[filename],
+                "documents": docs
+            }
+
+        cls._write_cache()
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Retrieve the documents in a YAML file, parsing it only if it changed
+        since the snapshot was compiled.
+        """
+
+        cls.compile([filename])
+        return cls._files[filename]["documents"]
@@ -0,0 +1,34 @@
+"""
+Helpers for files that are shared between processes.
+"""
+
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+def write_atomic(path, data):
+    """
+    Write bytes or text to a file such that readers, including other
+    processes, either find the previous file or the complete new file.
+    The data is written to a temporary file next to it, which then replaces
+    the file, and the temporary file is removed if writing fails.
+    """
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    path = Path(path)
+    temp_file = NamedTemporaryFile(dir=str(path.parent),
+                                   prefix=f".{path.name}.", delete=False)
+    try:
+        with temp_file:
+            temp_file.write(data)
+
+        os.replace(temp_file.name, str(path))
+    except BaseException:
+        try:
+            os.unlink(temp_file.name)
+        except FileNotFoundError:
+            pass
+
+        raise
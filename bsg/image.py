@@ -1,19 +1,175 @@
-from glob import glob
+import asyncio
+from collections import OrderedDict
+import logging
+import os
 from pathlib import Path
+from threading import Lock
+import time
 from PIL import Image, ImageChops
-import requests
-from requests.exceptions import ConnectionError as ConnectError, HTTPError, Timeout
-import yaml
 from .card import Cards
+from .client import HttpError, shared_client
+from .data import Data
+
+class ImageStore:
+    """
+    Local storage of images by their BGG image ID. The directory is scanned
+    once to build an index from image IDs to their path, extension, size and
+    modification time, and the index is updated when images are added, so
+    that lookups do not access the file system. Images are optionally spread
+    over a number of subdirectories. If a maximum size in bytes is set, then
+    the least recently used images are removed when the total size of the
+    images exceeds it.
+    """
+
+    def __init__(self, path=Path("images"), shards=0, max_size=0):
+        self.path = path
+        self.shards = shards
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.total_size = 0
+        self.loaded = False
+        self.lock = Lock()
+
+    @staticmethod
+    def _parse_name(name):
+        image_id, _, extension = name.partition(".")
+        if not image_id.isdigit() or extension == "" or "." in extension:
+            return None
+
+        return image_id, extension
+
+    def _scan(self, directory):
+        with os.scandir(str(directory)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield from self._scan(directory / entry.name)
+                elif entry.is_file():
+                    parsed = self._parse_name(entry.name)
+                    if parsed is not None:
+                        yield parsed, directory / entry.name, entry.stat()
+
+    def load(self):
+        """
+        Build the index from the images in the directory and its shard
+        subdirectories, if this was not yet done.
+        """
+
+        with self.lock:
+            if self.loaded:
+                return
+
+            found = []
+            if self.path.exists():
+                found = sorted(self._scan(self.path),
+                               key=lambda item: item[2].st_mtime)
+
+            for (image_id, extension), path, stat in found:
+                self._add(image_id, extension, path, stat)
+
+            self.loaded = True
+            self._evict()
+            logging.info("Indexed %d images (%d bytes)", len(self.entries),
+                         self.total_size)
+
+    def _add(self, image_id, extension, path, stat):
+        self._discard(image_id)
+        self.entries[image_id] = {
+            "path": path,
+            "extension": extension,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime
+        }
+        self.total_size += stat.st_size
+
+    def _discard(self, image_id):
+        entry = self.entries.pop(image_id, None)
+        if entry is not None:
+            self.total_size -= entry["size"]
+
+        return entry
+
+    def _evict(self, keep=None):
+        if self.max_size <= 0:
+            return
+
+        for image_id in list(self.entries):
+            if self.total_size <= self.max_size:
+                break
+            if image_id == keep:
+                continue
+
+            entry = self._discard(image_id)
+            try:
+                entry["path"].unlink()
+            except FileNotFoundError:
+                pass
+
+    def find(self, image_id):
+        """
+        Retrieve the path of a stored image, or `None` if it is not stored.
+        """
+
+        self.load()
+        with self.lock:
+            entry = self.entries.get(str(image_id))
+            if entry is None:
+                return None
+
+            self.entries.move_to_end(str(image_id))
+            return entry["path"]
+
+    def discard(self, image_id):
+        """
+        Remove an image from the index, for example because its file was
+        found to be removed outside of the store when it was used.
+        """
+
+        with self.lock:
+            self._discard(str(image_id))
+
+    def get_path(self, image_id, extension):
+        """
+        Determine the path to which an image should be stored.
+        """
+
+        if self.shards > 0:
+            directory = self.path / f"{int(image_id) % self.shards:02x}"
+            directory.mkdir(parents=True, exist_ok=True)
+        else:
+            directory = self.path
+
+        return directory / f"{image_id}.{extension}"
+
+    def add(self, image_id, path):
+        """
+        Add an image that was written to its path to the index.
+        """
+
+        self.load()
+        image_id = str(image_id)
+        extension = self._parse_name(path.name)[1]
+        stat = path.stat()
+        with self.lock:
+            self._add(image_id, extension, path, stat)
+            self._evict(keep=image_id)
 
 class Images:
     """
     Handler for downloading images from BGG.
     """
 
+    # Number of images that are retrieved at the same time when prefetching
+    PREFETCH_LIMIT = 8
+    # Number of seconds during which failed tag lookups are not retried
+    FAILURE_TTL = 300
+
     images = {}
     banners = {}
+    tags = {}
+    failed_tags = {}
     _priorities = None
+    client = shared_client
+    store = ImageStore()
 
     @classmethod
     def normalize_name(cls, name):
@@ -24,25 +180,23 @@ class Images:
         if cls.images:
             return
 
-        with open("images.yml") as images_file:
-            for data in yaml.safe_load_all(images_file):
-                if data["type"].endswith("banners"):
-                    cls.banners[data["type"]] = {
-                        cls.normalize_name(name): image_id
-                        for image_id, name in data["images"].items()
-                    }
-
-                text_format = data.get("format", "{}")
-                for image_id, text in data["images"].items():
-                    cls.images[image_id] = {
-                        "formatted": text_format.format(text),
-                        "text": text,
-                        "titles": data.get("titles", [])
-                    }
+        for data in Data.load("images.yml"):
+            if data["type"].endswith("banners"):
+                cls.banners[data["type"]] = {
+                    cls.normalize_name(name): image_id
+                    for image_id, name in data["images"].items()
+                }
+
+            text_format = data.get("format", "{}")
+            for image_id, text in data["images"].items():
+                cls.images[image_id] = {
+                    "formatted": text_format.format(text),
+                    "text": text,
+                    "titles": data.get("titles", [])
+                }
 
     def __init__(self, api_url):
         self.api_url = api_url
-        self.session = requests.Session()
         self.load()
 
     @property
@@ -60,6 +214,9 @@ class Images:
         return self._priorities
 
 
+    def _find(self, image_id):
+        return self.store.find(image_id)
+
     def retrieve(self, image_id, tags=False, download=True):
         """
         Retrieve an image by its ID. If an image is a known banner (either for
@@ -77,40 +234,110 @@ class Images:
         if image_id in self.images:
             return self.images[image_id]
 
-        if tags:
-            return self.retrieve_tags(image_id)
+        if not tags:
+            image_path = self._find(image_id)
+            if image_path is not None or not download:
+                return image_path
 
-        for image_path in glob(f"images/{image_id}.*"):
-            return Path(image_path)
+        return self.client.run(self.retrieve_async(image_id, tags=tags,
+                                                   download=download))
 
-        if not download:
-            return None
+    async def retrieve_async(self, image_id, tags=False, download=True):
+        """
+        Retrieve an image by its ID without blocking the event loop. The
+        result is the same as that of `retrieve`.
+        """
+
+        if image_id in self.images:
+            return self.images[image_id]
+
+        if tags:
+            return await self.retrieve_tags_async(image_id)
+
+        image_path = self._find(image_id)
+        if image_path is not None or not download:
+            return image_path
 
         # Retrieve the API data for the image.
-        request = self.session.get(f"{self.api_url}/images/{image_id}")
         try:
+            request = await self.client.get(f"{self.api_url}/images/{image_id}")
             request.raise_for_status()
             result = request.json()
             extension = result["extension"]
             url = result["images"]["original"]["url"]
-        except (ConnectError, HTTPError, Timeout, ValueError, KeyError):
+        except (HttpError, ValueError, KeyError):
             logging.exception("Could not look up information about image ID %s",
                               image_id)
             return None
 
-        return self.download(url, f"{image_id}.{extension}")
+        image_path = self.store.get_path(image_id, extension)
+        try:
+            response = await self.client.download(url, image_path)
+            response.raise_for_status()
+        except HttpError:
+            logging.exception("Could not download image ID %s", image_id)
+            return None
+
+        self.store.add(image_id, image_path)
+        return image_path
+
+    def _is_missing(self, image_id, tags=False, download=True):
+        if image_id in self.images:
+            return False
+        if tags:
+            return image_id not in self.tags and \
+                not self._has_failed_tags(image_id)
+
+        return download and self._find(image_id) is None
+
+    def prefetch(self, image_ids, tags=False, download=True):
+        """
+        Retrieve multiple images by their IDs concurrently, such that later
+        calls to `retrieve` with the same arguments do not need to access the
+        API for them. Returns nothing.
+        """
+
+        missing = [
+            image_id for image_id in dict.fromkeys(image_ids)
+            if self._is_missing(image_id, tags=tags, download=download)
+        ]
+        if missing:
+            self.client.run(self.prefetch_async(missing, tags=tags,
+                                                download=download))
+
+    async def prefetch_async(self, image_ids, tags=False, download=True):
+        semaphore = asyncio.Semaphore(self.PREFETCH_LIMIT)
+
+        async def fetch(image_id):
+            async with semaphore:
+                return await self.retrieve_async(image_id, tags=tags,
+                                                 download=download)
+
+        # A failed retrieval is logged and does not stop the others
+        results = await asyncio.gather(*[
+            fetch(image_id) for image_id in image_ids
+        ], return_exceptions=True)
+        for image_id, result in zip(image_ids, results):
+            if isinstance(result, Exception):
+                logging.error("Could not prefetch image ID %s", image_id,
+                              exc_info=result)
 
     def download(self, url, filename):
         """
         Download an image from a URL to the local storage.
-        Returns the Path of the local file.
+        Returns the Path of the local file, or `None` if the download failed.
         """
 
-        download = self.session.get(url, stream=True)
+        return self.client.run(self.download_async(url, filename))
+
+    async def download_async(self, url, filename):
         image_path = Path(f"images/{filename}")
-        with image_path.open("wb") as image_file:
-            for chunk in download.iter_content(chunk_size=1024):
-                image_file.write(chunk)
+        try:
+            response = await self.client.download(url, image_path)
+            response.raise_for_status()
+        except HttpError:
+            logging.exception("Could not download image from %s", url)
+            return None
 
         return image_path
 
@@ -123,15 +350,39 @@ class Images:
         in `None`.
         """
 
-        request = self.session.get(f"{self.api_url}/images/{image_id}/tags")
+        if image_id in self.tags:
+            return self.tags[image_id]
+        if self._has_failed_tags(image_id):
+            return None
+
+        return self.client.run(self.retrieve_tags_async(image_id))
+
+    def _has_failed_tags(self, image_id):
+        if image_id not in self.failed_tags:
+            return False
+        if self.failed_tags[image_id] < time.monotonic():
+            self.failed_tags.pop(image_id, None)
+            return False
+
+        return True
+
+    async def retrieve_tags_async(self, image_id):
+        if image_id in self.tags:
+            return self.tags[image_id]
+        if self._has_failed_tags(image_id):
+            return None
+
         try:
+            request = await self.client.get(f"{self.api_url}/images/{image_id}/tags")
             request.raise_for_status()
             result = request.json()
             sorted_tags = sorted(result['tags'], key=lambda tag: tag['count'])
             tags = [tag['rawtag'].lower() for tag in sorted_tags]
-        except (ConnectError, HTTPError, Timeout, ValueError, KeyError):
+        except (HttpError, ValueError, KeyError):
             logging.exception("Could not look up tags for image ID %s",
                               image_id)
+            # Do not look up the tags again shortly after a prefetch failed
+            self.failed_tags[image_id] = time.monotonic() + self.FAILURE_TTL
             return None
 
         banner_type = ""
@@ -150,14 +401,16 @@ class Images:
             elif '_' not in name:
                 characters.append(name)
 
-        if banner_type not in self.banners:
-            return None
-
-        for character in characters:
-            if character in self.banners[banner_type]:
-                return self.images[self.banners[banner_type][character]]
+        banner = None
+        if banner_type in self.banners:
+            for character in characters:
+                if character in self.banners[banner_type]:
+                    banner = self.images[self.banners[banner_type][character]]
+                    break
 
-        return None
+        # Keep the result of the lookup for later retrievals
+        self.tags[image_id] = banner
+        return banner
 
     def banner(self, banner_type, name):
         """
@@ -1,9 +1,431 @@
+from collections import Counter, defaultdict, OrderedDict
+from glob import glob
+import json
+import logging
+from math import log
+from pathlib import Path
+import re
+import time
 from elasticsearch_dsl import Document, Boolean, Float, Integer, Keyword, \
     Object, normalizer, Q, Text
+import snowballstemmer
+from .data import Data
+from .files import write_atomic
 
 lowercase = normalizer('lower', filter=['lowercase'])
 
-class Card(Document):
+class ElasticsearchBackend:
+    """
+    Search backend that queries the indexes in the main Elasticsearch
+    connection.
+    """
+
+    def search_freetext(self, document, text, filters, limit):
+        search = document.search(using='main')
+        query = Q('multi_match', query=text, fields=document.SEARCH_FIELDS) | \
+                Q('fuzzy', name=text) | \
+                Q('fuzzy', text=text)
+        for field, value in filters.items():
+            search = search.filter('term', **{field: value})
+        search_query = search[:limit].query(query).extra(track_total_hits=True)
+        result = search_query.execute()
+        count = result.hits.total
+        if not isinstance(count, int):
+            count = count['value']
+        return result, count
+
+    def find(self, document, terms):
+        search = document.search(using='main')
+        for field, value in terms.items():
+            query = 'terms' if isinstance(value, list) else 'term'
+            search = search.filter(query, **{field: value})
+        return search.scan()
+
+class MemoryIndex:
+    """
+    Inverted index of documents of one type, kept in memory.
+    """
+
+    def __init__(self, backend, document, docs):
+        self.backend = backend
+        self.document = document
+        self.name = document._index._name
+        self.fields = document._index.to_dict()["mappings"]["properties"]
+        self.sources = []
+        self.ids = []
+        self.postings = defaultdict(lambda: defaultdict(dict))
+        self.lengths = defaultdict(dict)
+        self.counts = Counter()
+        for doc in docs:
+            self.add(doc.meta.id, doc.to_dict())
+
+        self.averages = {
+            field: sum(lengths.values()) / len(lengths)
+            for field, lengths in self.lengths.items() if lengths
+        }
+        self.vocabulary = defaultdict(lambda: defaultdict(list))
+        for field, postings in self.postings.items():
+            for term in postings:
+                self.vocabulary[field][len(term)].append(term)
+
+    def normalize(self, field, value):
+        if self.fields.get(field, {}).get("normalizer") == "lower":
+            return str(value).lower()
+
+        return value
+
+    def get_terms(self, field, value):
+        if self.fields[field]["type"] == "text":
+            return self.backend.analyze(value)
+
+        return [self.normalize(field, value)]
+
+    def add(self, doc_id, source):
+        doc = len(self.sources)
+        self.ids.append(doc_id)
+        self.sources.append(source)
+        for field, info in self.fields.items():
+            if field not in source or info["type"] not in ("text", "keyword"):
+                continue
+
+            values = source[field]
+            if not isinstance(values, list):
+                values = [values]
+
+            terms = []
+            for value in values:
+                terms.extend(self.get_terms(field, value))
+
+            self.counts[field] += 1
+            for term, count in Counter(terms).items():
+                self.postings[field][term][doc] = count
+
+            # Keyword fields have no length normalization
+            if info["type"] == "text":
+                self.lengths[field][doc] = len(terms)
+
+    def score_term(self, field, term, doc_freq=None, boost=1.0):
+        """
+        Calculate BM25 scores of the documents that contain the term in the
+        field.
+        """
+
+        postings = self.postings[field].get(term, {})
+        if doc_freq is None:
+            doc_freq = len(postings)
+
+        count = self.counts[field]
+        idf = log(1 + (count - doc_freq + 0.5) / (doc_freq + 0.5))
+        k1 = self.backend.K1
+        b = self.backend.B
+        scores = {}
+        for doc, freq in postings.items():
+            if doc in self.lengths[field]:
+                norm = 1 - b + b * self.lengths[field][doc] / \
+                    self.averages[field]
+            else:
+                norm = 1
+            scores[doc] = boost * idf * freq / (freq + k1 * norm)
+
+        return scores
+
+    def score_match(self, field, text):
+        scores = Counter()
+        for term in self.get_terms(field, text):
+            scores.update(self.score_term(field, term))
+
+        return scores
+
+    def score_fuzzy(self, field, text):
+        """
+        Calculate scores of a fuzzy query of the unanalyzed text with an
+        automatic number of edits, where similar terms have the same
+        document frequency and are boosted by their similarity.
+        """
+
+        if len(text) <= 2:
+            max_edits = 0
+        elif len(text) <= 5:
+            max_edits = 1
+        else:
+            max_edits = 2
+
+        matches = {}
+        vocabulary = self.vocabulary[field]
+        for length in range(len(text) - max_edits, len(text) + max_edits + 1):
+            for term in vocabulary.get(length, []):
+                edits = self.backend.distance(term, text, max_edits)
+                if edits <= max_edits:
+                    matches[term] = 1 - edits / min(len(term), len(text))
+
+        if not matches:
+            return Counter()
+
+        doc_freq = max(len(self.postings[field][term]) for term in matches)
+        scores = Counter()
+        for term, boost in matches.items():
+            scores.update(self.score_term(field, term, doc_freq=doc_freq,
+                                          boost=boost))
+
+        return scores
+
+    def matches(self, doc, terms):
+        source = self.sources[doc]
+        for name, value in terms.items():
+            field, _, subfield = name.partition('__')
+            values = source.get(field)
+            if not isinstance(values, list):
+                values = [values]
+            options = value if isinstance(value, list) else [value]
+            if subfield == "":
+                values = [self.normalize(field, item) for item in values]
+                options = [self.normalize(field, item) for item in options]
+            if not any(item in options for item in values):
+                return False
+
+        return True
+
+    def hit(self, doc, score=None):
+        return self.document.from_es({
+            "_index": self.name,
+            "_id": self.ids[doc],
+            "_score": score,
+            "_source": self.sources[doc]
+        })
+
+class MemoryBackend:
+    """
+    Search backend with in-memory inverted indexes of the documents created
+    from the data files. The analysis and scoring resembles that of the
+    Elasticsearch indexes and queries, so that scores of results can be
+    compared in the same way. The indexes are rebuilt when the generation
+    marker, which is written after each import, or one of the data files
+    changes.
+    """
+
+    # Stop words of the snowball analyzer
+    STOP_WORDS = {
+        "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if",
+        "in", "into", "is", "it", "no", "not", "of", "on", "or", "such",
+        "that", "the", "their", "then", "there", "these", "they", "this",
+        "to", "was", "will", "with"
+    }
+    TOKEN_REGEX = re.compile(r"\w+(?:'\w+)*")
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.stemmer = snowballstemmer.stemmer('english')
+        self.indexes = {}
+        self.generation = SearchCache.get_generation()
+
+    def analyze(self, text):
+        return [
+            self.stemmer.stemWord(token)
+            for token in self.TOKEN_REGEX.findall(str(text).lower())
+            if token not in self.STOP_WORDS
+        ]
+
+    @staticmethod
+    def distance(first, second, limit):
+        """
+        Calculate the number of edits (insertions, deletions, substitutions
+        and transpositions) between two strings. If this is more than the
+        `limit`, then a number higher than the limit is returned.
+        """
+
+        if abs(len(first) - len(second)) > limit:
+            return limit + 1
+
+        previous = None
+        row = list(range(len(second) + 1))
+        for i, char in enumerate(first, 1):
+            current = [i] + [0] * len(second)
+            for j, other in enumerate(second, 1):
+                current[j] = min(row[j] + 1, current[j - 1] + 1,
+                                 row[j - 1] + (char != other))
+                if previous is not None and i > 1 and j > 1 and \
+                    char == second[j - 2] and first[i - 2] == other:
+                    current[j] = min(current[j], previous[j - 2] + 1)
+            if min(current) > limit:
+                return limit + 1
+            previous, row = row, current
+
+        return row[-1]
+
+    def get_index(self, document):
+        generation = SearchCache.get_generation()
+        if generation != self.generation:
+            if self.indexes:
+                logging.info("Data changed, rebuilding memory indexes")
+            self.indexes.clear()
+            self.generation = generation
+
+        if document not in self.indexes:
+            docs = (doc for _, doc in document.from_data())
+            self.indexes[document] = MemoryIndex(self, document, docs)
+            logging.info("Built memory index for %s with %d documents",
+                         document._index._name,
+                         len(self.indexes[document].sources))
+
+        return self.indexes[document]
+
+    def search_freetext(self, document, text, filters, limit):
+        index = self.get_index(document)
+        best = Counter()
+        for spec in document.SEARCH_FIELDS:
+            field, _, boost = spec.partition('^')
+            for doc, score in index.score_match(field, text).items():
+                best[doc] = max(best[doc], score * float(boost or 1))
+
+        scores = best + index.score_fuzzy('name', text) + \
+            index.score_fuzzy('text', text)
+        docs = sorted((doc for doc in scores if index.matches(doc, filters)),
+                      key=lambda doc: (-scores[doc], doc))
+        result = [index.hit(doc, scores[doc]) for doc in docs[:limit]]
+        return result, len(docs)
+
+    def find(self, document, terms):
+        index = self.get_index(document)
+        for doc in range(len(index.sources)):
+            if index.matches(doc, terms):
+                yield index.hit(doc)
+
+class SearchCache:
+    """
+    Cache of free text search results with a least recently used eviction
+    policy and a time to live. The cache is cleared when the generation
+    marker, which is written after each import, or one of the data files
+    changes.
+    """
+
+    GENERATION_PATH = Path("data/_generation")
+
+    def __init__(self, size=256, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = self.get_generation()
+        self.stats = Counter()
+
+    @classmethod
+    def get_generation(cls):
+        """
+        Retrieve the current generation of the indexes and the data files.
+        The generation marker is `None` if no import wrote a marker. The data
+        files are included, since the memory backend reads them directly, so
+        edits show up without an import.
+        """
+
+        try:
+            stat = cls.GENERATION_PATH.stat()
+        except OSError:
+            marker = None
+        else:
+            marker = (stat.st_mtime_ns, stat.st_size)
+
+        return (marker, Data.get_sources())
+
+    @classmethod
+    def write_generation(cls):
+        """
+        Write a new generation marker to invalidate the caches of running
+        processes after the indexes changed.
+        """
+
+        write_atomic(cls.GENERATION_PATH, str(time.time_ns()))
+
+    @staticmethod
+    def get_key(document, text, filters, limit):
+        return (document.__name__, text,
+                tuple(sorted(filters.items())), limit)
+
+    def get(self, key):
+        generation = self.get_generation()
+        if generation != self.generation:
+            if self.entries:
+                self.stats["invalidations"] += 1
+            self.entries.clear()
+            self.generation = generation
+
+        if key not in self.entries:
+            self.stats["misses"] += 1
+            return None
+
+        expires, value = self.entries[key]
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get_stats(self):
+        """
+        Retrieve the number of cached entries, hits, misses, evictions due
+        to the size limit, expirations and invalidations due to imports.
+        """
+
+        stats = dict(self.stats)
+        stats["entries"] = len(self.entries)
+        stats["size"] = self.size
+        requests = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_rate"] = stats.get("hits", 0) / requests if requests else 0
+        return stats
+
+class SearchMixin:
+    """
+    Search operations for document types that are performed by the selected
+    search backend.
+    """
+
+    BACKENDS = {
+        "elasticsearch": ElasticsearchBackend,
+        "memory": MemoryBackend
+    }
+
+    backend = ElasticsearchBackend()
+    cache = SearchCache()
+
+    @classmethod
+    def use_backend(cls, name, cache_size=256, cache_ttl=3600):
+        SearchMixin.backend = cls.BACKENDS[name]()
+        SearchMixin.cache = SearchCache(size=cache_size, ttl=cache_ttl)
+
+    @classmethod
+    def _search_freetext(cls, text, filters, limit):
+        # Fuzzy queries compare the text as given, so only whitespace is
+        # normalized before it is used for both the cache key and the query.
+        text = ' '.join(text.split())
+        key = cls.cache.get_key(cls, text, filters, limit)
+        result = cls.cache.get(key)
+        if result is None:
+            result = cls.backend.search_freetext(cls, text, filters, limit)
+            cls.cache.put(key, result)
+
+        return result
+
+    @classmethod
+    def find(cls, **terms):
+        """
+        Retrieve all documents that have the exact values of the provided
+        keywords. If a value is a list, then the document may have any of the
+        values. Keywords may use the `__raw` suffix for the raw field.
+        """
+
+        return cls.backend.find(cls, terms)
+
+class Card(SearchMixin, Document):
     SEARCH_FIELDS = ['path^3', 'name^4', 'text^2', 'deck', 'expansion^2', 'cylon', 'skills']
 
     name = Text(analyzer='snowball', fields={'raw': Keyword()})
@@ -38,22 +460,122 @@ class Card(Document):
 
     @classmethod
     def search_freetext(cls, text, deck='', expansion='', limit=10):
-        search = cls.search(using='main')
-        query = Q('multi_match', query=text, fields=cls.SEARCH_FIELDS) | \
-                Q('fuzzy', name=text) | \
-                Q('fuzzy', text=text)
+        filters = {}
         if deck != '':
-            search = search.filter('term', deck=deck)
+            filters['deck'] = deck
         if expansion != '':
-            search = search.filter('term', expansion=expansion)
-        search_query = search[:limit].query(query)
-        result = search_query.execute()
-        count = search_query.count()
-        if not isinstance(count, int):
-            count = count['value']
-        return result, count
+            filters['expansion'] = expansion
+        return cls._search_freetext(text, filters, limit)
 
-class Location(Document):
+    @classmethod
+    def from_data(cls, filenames=None, deck=None, expansion=None, names=None):
+        """
+        Create card documents from the sections of the YAML data files.
+        Optionally only create cards from a deck, an expansion or with one of
+        the provided names. Generates tuples of the filename and the document.
+        """
+
+        if filenames is None:
+            filenames = sorted(glob("data/*.yml"))
+
+        meta = Data.load("data/_meta.yml")[0]
+        for filename in filenames:
+            for data in Data.load(filename):
+                if data.get('meta') or 'cards' not in data:
+                    continue
+
+                if expansion is not None and data['expansion'] != expansion:
+                    continue
+                if deck is not None and data['deck'] != deck:
+                    continue
+
+                for doc in cls._from_section(data, meta, names):
+                    yield filename, doc
+
+    @classmethod
+    def _from_section(cls, data, meta, names):
+        expansion = data['expansion']
+        expansion_name = meta['expansions'].get(expansion, {}).get('name', expansion)
+
+        deck = data['deck']
+        deck_name = meta['decks'][deck]['name']
+
+        # Deck properties
+        jump = meta['decks'][deck].get('jump')
+        ability = meta['decks'][deck].get('ability')
+        reckless = meta['decks'][deck].get('reckless')
+        agenda = data.get('agenda')
+        path = data.get('path', meta['decks'][deck].get('path', deck_name))
+        expansion_seed = data.get('seed', {})
+
+        # Insert with spaces for better Elastisearch tokenization
+        replace = data.get('replace', meta['decks'][deck].get('replace', '_'))
+        ext = data.get('ext', meta['decks'][deck].get('ext'))
+
+        for card in data['cards']:
+            if names and card['name'] not in names:
+                continue
+
+            count = card.get('count')
+            if isinstance(count, int):
+                count = [count]
+
+            card_path = card.get('path', card['name'])
+            value = card.get('value')
+            if value is not None:
+                if isinstance(value, int):
+                    value = [value]
+                else:
+                    card_path = f"{card_path} {card['value'][0]}"
+
+            skills = card.get('skills',
+                              [card['skill']] if 'skill' in card else [])
+            cylon = card.get('cylon')
+            text = json.dumps(card.get('text', {}))
+            succession = card.get('succession', {})
+            default_succession = 99 if 'class' in card else None
+            if isinstance(expansion_seed, dict):
+                seed = dict(card.get('seed', expansion_seed))
+            elif 'seed' in card:
+                seed = {"_expr": f"({expansion_seed}) and ({card['seed']})"}
+            else:
+                seed = {"_expr": expansion_seed}
+            if 'alternate' in card:
+                seed['_alternate'] = card['alternate']
+
+            doc = cls(meta={'id': f"{deck}/{expansion}/{card_path}"},
+                      name=card['name'],
+                      prefix=path,
+                      path=card_path,
+                      replace=card.get('replace', replace),
+                      url=card.get('url'),
+                      image=card.get('image'),
+                      bbox=card.get('bbox'),
+                      deck=deck,
+                      expansion=expansion,
+                      ext=card.get('ext', ext),
+                      seed=seed,
+                      index=card.get('index'),
+                      count=count,
+                      value=value,
+                      destination=card.get('destination'),
+                      text=text,
+                      skills=skills,
+                      cylon=[cylon] if isinstance(cylon, str) else cylon,
+                      jump=card.get('jump', jump),
+                      character_class=card.get('class'),
+                      president=succession.get('president', default_succession),
+                      admiral=succession.get('admiral', default_succession),
+                      cag=succession.get('cag', default_succession),
+                      allegiance=card.get('allegiance'),
+                      ability=card.get('ability', ability),
+                      reckless=card.get('reckless', reckless),
+                      agenda=agenda)
+            logging.debug('Loaded %s (%s card from %s): %r', card['name'],
+                          deck_name, expansion_name, doc.to_dict())
+            yield doc
+
+class Location(SearchMixin, Document):
     SEARCH_FIELDS = ['name^2', 'text', 'expansion', 'skills']
 
     board_name = Text(analyzer='snowball', fields={'raw': Keyword()})
@@ -75,15 +597,66 @@ class Location(Document):
 
     @classmethod
     def search_freetext(cls, text, expansion='', limit=10):
-        search = cls.search(using='main')
-        query = Q('multi_match', query=text, fields=cls.SEARCH_FIELDS) | \
-                Q('fuzzy', name=text) | \
-                Q('fuzzy', text=text)
+        filters = {}
         if expansion != '':
-            search = search.filter('term', expansion=expansion)
-        search_query = search[:limit].query(query)
-        result = search_query.execute()
-        count = search_query.count()
-        if not isinstance(count, int):
-            count = count['value']
-        return result, count
+            filters['expansion'] = expansion
+        return cls._search_freetext(text, filters, limit)
+
+    @classmethod
+    def from_data(cls, filenames=None):
+        """
+        Create board and location documents from the YAML data files.
+        Generates tuples of the filename and the document.
+        """
+
+        if filenames is None:
+            filenames = ["data/locations.yml"]
+
+        for filename in filenames:
+            for data in Data.load(filename):
+                for board in data['boards']:
+                    yield from cls._from_board(filename, data, board)
+
+    @classmethod
+    def _from_board(cls, filename, data, board):
+        expansion = data['expansion']
+        board_name = board['name']
+        path = board.get('path', board_name)
+        image = board.get('image')
+        ext = board['ext']
+        seed = board.get('seed', data.get('seed', {}))
+        doc = cls(meta={'id': f"{expansion}/{board_name}"},
+                  board_name=board_name,
+                  path=path,
+                  image=image,
+                  ext=ext,
+                  name=board_name,
+                  expansion=expansion,
+                  seed=seed,
+                  bbox=board.get('bbox'),
+                  text=json.dumps({}))
+        logging.debug('Loaded %s (board from %s)', board_name, expansion)
+        yield filename, doc
+
+        for location in board['locations']:
+            value = location.get('value')
+            if isinstance(value, int):
+                value = [value]
+            loc = cls(meta={'id': f"{expansion}/{board_name}/{location['name']}"},
+                      board_name=board_name,
+                      path=path,
+                      image=image,
+                      ext=ext,
+                      name=location['name'],
+                      expansion=expansion,
+                      seed=seed,
+                      hazardous=location.get('hazardous', False),
+                      bbox=location.get('bbox'),
+                      value=value,
+                      skills=location.get('skills'),
+                      occupation=location.get('occupation'),
+                      text=json.dumps(location.get('text', {})))
+            logging.debug('Loaded %s (%s location from %s): %r',
+                          location['name'], board_name, expansion,
+                          loc.to_dict())
+            yield filename, loc
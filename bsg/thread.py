@@ -2,110 +2,302 @@
 BGG BYC thread retrieval
 """
 
+import asyncio
 from glob import glob
+import json
 import logging
 from pathlib import Path
-import re
-import requests
-from requests.exceptions import ConnectionError as ConnectError, HTTPError, Timeout
+import time
+from .bbcode import BBCodeMarkdown
 from .byc import ByYourCommand
+from .client import HttpError, shared_client
+from .files import write_atomic
+from .image import Images
 
 class Thread:
     """
     Handler for retrieving posts from BGG.
+
+    The thread is followed incrementally: the number of posts and the ID of
+    the last article that was seen are stored along with a rolling history
+    of the latest BYC posts and their seeds, so that only articles after the
+    last seen one are processed, and the thread is not looked up again while
+    the last check is more recent than `max_age` seconds.
     """
 
-    PATH_REGEX = re.compile(r"game/bgg-(?P<thread_id>\d+)-(?P<post>\d+)\.txt")
+    # Number of BYC posts to keep in the history of a thread
+    HISTORY_SIZE = 10
+
+    # Number of pages to retrieve backward when looking for new articles
+    MAX_PAGES = 3
+
+    max_age = 0
+    client = shared_client
 
     def __init__(self, api_url):
         self.api_url = api_url
-        self.session = requests.Session()
 
-    def clear(self, thread_id):
+    @staticmethod
+    def _get_path(thread_id):
+        return Path(f"game/bgg-{thread_id}.json")
+
+    def load(self, thread_id):
         """
-        Remove cached posts from the thread.
+        Retrieve the followed state of the thread.
         """
 
-        for cache_path in glob(f"game/bgg-{thread_id}-*.txt"):
-            Path(cache_path).unlink()
+        try:
+            with self._get_path(thread_id).open('r') as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError):
+            return {
+                "numposts": 0,
+                "last_article": 0,
+                "checked": 0,
+                "posts": []
+            }
+
+    def _save(self, thread_id, state):
+        path = self._get_path(thread_id)
+        if not path.exists():
+            # Remove the posts that earlier versions cached per thread
+            for cache_path in glob(f"game/bgg-{thread_id}-*.txt"):
+                Path(cache_path).unlink()
+
+        write_atomic(path, json.dumps(state))
 
-    def retrieve(self, thread_id, download=True):
+    def history(self, thread_id):
         """
-        Retrieve the latest BYC post in a thread by its ID. If the thread's
-        latest post is already available locally then the post and seed from
-        the cached file is returned. Otherwise, the latest post body and seed
-        are returned.
+        Retrieve the locally known BYC posts of the thread, from oldest to
+        latest, as dictionaries with the article "id", "body" and "seed".
         """
 
-        if not download:
-            last_post = 0
-            for cache_path in glob(f"game/bgg-{thread_id}-*.txt"):
-                match = self.PATH_REGEX.match(cache_path)
-                if match:
-                    last_post = max(last_post, int(match.group("post")))
+        return self.load(thread_id)["posts"]
+
+    @staticmethod
+    def _get_latest(state):
+        if not state["posts"]:
+            return None, {}
+
+        post = state["posts"][-1]
+        return post["body"], post["seed"]
+
+    async def retrieve(self, thread_id, download=True, max_age=None):
+        """
+        Retrieve the latest BYC post in a thread by its ID. If the thread has
+        no new posts since it was last followed, or if it was checked within
+        `max_age` seconds, then the post and seed from the history are
+        returned. Otherwise, new articles are retrieved and the latest post
+        body and seed are returned.
+        """
+
+        state = self.load(thread_id)
+        if max_age is None:
+            max_age = self.max_age
+        if not download or time.time() - state["checked"] < max_age:
+            return self._get_latest(state)
 
-            if last_post == 0:
-                return None, {}
+        return self._get_latest(await self.follow(thread_id, state))
 
-            path = Path(f"game/bgg-{thread_id}-{last_post}.txt")
-            return self._retrieve_cached(path)
+    async def follow(self, thread_id, state=None):
+        """
+        Look up the thread and retrieve the articles that were posted since
+        the last seen article. Update the followed state with BYC posts from
+        the new articles and return the state.
+        """
 
-        thread_request = self.session.get(f"{self.api_url}/threads/{thread_id}")
+        if state is None:
+            state = self.load(thread_id)
+
+        url = f"{self.api_url}/threads/{thread_id}"
         try:
+            thread_request = await self.client.get(url)
             thread_request.raise_for_status()
             thread = thread_request.json()
             last_post = thread["numposts"]
             pages = thread["numpages"]
-        except (ConnectError, HTTPError, Timeout, ValueError, KeyError):
+        except (HttpError, ValueError, KeyError):
             logging.exception("Could not look up thread ID %s", thread_id)
-            return None, {}
+            return state
+
+        if last_post != state["numposts"]:
+            articles = await self.download(thread_id, pages,
+                                           state["last_article"])
+            if articles is None:
+                return state
 
-        article_path = Path(f"game/bgg-{thread_id}-{last_post}.txt")
-        if article_path.exists():
-            return self._retrieve_cached(article_path)
+            for article in articles:
+                article_id = int(article["id"])
+                body = f'[q="{article["author"]}"]{article["body"]}[/q]'
+                seed = ByYourCommand.get_game_seed(body)
+                if seed:
+                    state["posts"].append({
+                        "id": article_id,
+                        "body": body,
+                        "seed": seed
+                    })
+                state["last_article"] = max(state["last_article"], article_id)
 
-        self.clear(thread_id)
-        return self.download(thread_id, last_post, pages)
+            state["posts"] = state["posts"][-self.HISTORY_SIZE:]
+            state["numposts"] = last_post
 
-    def _retrieve_cached(self, path):
-        with path.open('r') as article_file:
-            body = article_file.read()
-            return body, ByYourCommand.get_game_seed(body)
+        state["checked"] = time.time()
+        self._save(thread_id, state)
+        return state
 
-    def download(self, thread_id, last_post, pages):
+    async def download(self, thread_id, pages, last_article=0):
         """
-        Retrieve the latest BYC post from the thread as well as the game seed.
+        Retrieve the articles from the thread that were posted after the
+        article with the ID `last_article`, starting from the last page and
+        going backward until that article (or when the thread was not yet
+        followed, a BYC post) is found. Returns the new articles in the order
+        of the thread, or `None` if they could not be retrieved.
         """
 
-        article_request = self.session.get(f"{self.api_url}/articles",
-                                           params={
-                                               "threadid": thread_id,
-                                               "pageid": pages
-                                           })
-        try:
-            article_request.raise_for_status()
-            articles = article_request.json()
-            for article in reversed(articles["articles"]):
-                body = f'[q="{article["author"]}"]{article["body"]}[/q]'
-                game_state = ByYourCommand.get_game_seed(body)
-                if game_state:
-                    article_path = Path(f"game/bgg-{thread_id}-{last_post}.txt")
-                    with article_path.open('w') as article_file:
-                        article_file.write(body)
-                    return body, game_state
-        except (ConnectError, HTTPError, Timeout, ValueError, KeyError):
-            logging.info("Could not look up article #%d for thread ID %d",
-                         last_post, thread_id)
-
-        return None, {}
-
-    def get_author(self, author_id):
-        author_request = self.session.get(f"{self.api_url}/users/{author_id}")
+        articles = []
+        for page in range(pages, max(0, pages - self.MAX_PAGES), -1):
+            params = {"threadid": str(thread_id), "pageid": str(page)}
+            try:
+                article_request = await self.client.get(f"{self.api_url}/articles",
+                                                        params=params)
+                article_request.raise_for_status()
+                page_articles = article_request.json()["articles"]
+                new_articles = [
+                    article for article in page_articles
+                    if int(article["id"]) > last_article
+                ]
+            except (HttpError, ValueError, KeyError):
+                logging.info("Could not look up page %d for thread ID %d",
+                             page, thread_id)
+                return None
+
+            articles[:0] = new_articles
+            if len(new_articles) < len(page_articles):
+                break
+
+            # Without a last seen article, stop at the latest BYC post
+            if last_article == 0 and any(
+                ByYourCommand.get_game_seed(article["body"])
+                for article in page_articles
+            ):
+                break
+
+        return articles
+
+    async def get_author(self, author_id):
+        url = f"{self.api_url}/users/{author_id}"
         try:
+            author_request = await self.client.get(url)
             author_request.raise_for_status()
             author = author_request.json()
             return author["username"]
-        except (ConnectError, HTTPError, Timeout, ValueError, KeyError):
+        except (HttpError, ValueError, KeyError):
             logging.info("Could not look up author %d", author_id)
 
         return None
+
+class ThreadPoller:
+    """
+    Background poller of BGG threads that follows them for new BYC posts and
+    publishes the latest post of each thread, with its seed and processed
+    BBCode, in a shared store. Threads are polled quickly after new posts or
+    requests for them, and the interval doubles up to a maximum while there
+    is no activity.
+    """
+
+    posts = {}
+    events = {}
+
+    def __init__(self, api_url, thread_ids, min_interval=30,
+                 max_interval=600):
+        self.thread = Thread(api_url)
+        self.images = Images(api_url)
+        self.thread_ids = thread_ids
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    @classmethod
+    def get(cls, thread_id):
+        """
+        Retrieve the latest polled post of the thread as a dictionary with the
+        "post", "seed", processed "text" and "bbcode" state as well as the time
+        the thread was "checked", or `None` if the thread is not polled (yet).
+        """
+
+        return cls.posts.get(thread_id)
+
+    @classmethod
+    def wake(cls, thread_id):
+        """
+        Indicate activity for the thread, so that it is polled immediately and
+        then at the minimum interval.
+        """
+
+        if thread_id in cls.events:
+            cls.events[thread_id].set()
+
+    async def update(self, thread_id):
+        """
+        Follow the thread and publish its latest post if it changed. Returns
+        whether there was a new post.
+        """
+
+        state = await self.thread.follow(thread_id)
+        if not state["posts"]:
+            return False
+
+        latest = state["posts"][-1]
+        current = self.posts.get(thread_id)
+        if current is not None and current["post"] == latest["body"]:
+            current["checked"] = state["checked"]
+            return False
+
+        # Processing may look up images, so do not block the event loop
+        loop = asyncio.get_event_loop()
+        text, bbcode = await loop.run_in_executor(None, self.process,
+                                                  latest["body"])
+        self.posts[thread_id] = {
+            "post": latest["body"],
+            "seed": latest["seed"],
+            "text": text,
+            "bbcode": bbcode,
+            "checked": state["checked"]
+        }
+        return True
+
+    def process(self, post):
+        bbcode = BBCodeMarkdown(self.images)
+        text = bbcode.process_bbcode(post)
+        return text, bbcode.get_state()
+
+    async def poll(self, thread_id):
+        event = self.events.setdefault(thread_id, asyncio.Event())
+        interval = self.min_interval
+        while True:
+            event.clear()
+            try:
+                updated = await self.update(thread_id)
+            except Exception:
+                logging.exception("Could not poll thread ID %s", thread_id)
+                updated = False
+
+            if updated:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+
+            try:
+                await asyncio.wait_for(event.wait(), interval)
+                interval = self.min_interval
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, loop):
+        """
+        Create tasks in the event loop that poll each of the threads.
+        """
+
+        return [
+            loop.create_task(self.poll(thread_id))
+            for thread_id in self.thread_ids
+        ]
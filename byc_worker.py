@@ -0,0 +1,185 @@
+"""
+Worker process that runs BYC games on behalf of the bot, so that web drivers
+live outside of the bot process. The bot connects with `RemoteByYourCommand`
+and sends requests as JSON objects on single lines, and the worker responds
+with a JSON object on a line with either a "result" or an "error".
+"""
+
+import argparse
+import asyncio
+from base64 import b64encode
+import json
+import logging
+from bsg.byc import ByYourCommand, Dialog
+from bsg.client import shared_client
+from bsg.config import Config
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='BYC worker process')
+    log_options = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+    parser.add_argument('--log', default='INFO', choices=log_options,
+                        help='log level')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on for bot connections')
+    parser.add_argument('--port', default=8437, type=int,
+                        help='Port to listen on for bot connections')
+    args = parser.parse_args()
+    return args
+
+class Worker:
+    """
+    Owner of BYC games that handles requests from bot connections. Games are
+    started when they are first requested, and stopped when requested or
+    when the connection that last used them is closed. A game that a bot
+    reconnected to is owned by the new connection, so closing the old
+    connection leaves the game running.
+    """
+
+    METHODS = ("run_page", "retrieve_game_state", "screenshot", "stop")
+
+    # Maximum length of a request line, which contains a game state
+    LIMIT = 2**26
+
+    def __init__(self):
+        self.games = {}
+        self.owners = {}
+
+    @staticmethod
+    def get_key(request):
+        return (request["game_id"], request["user"])
+
+    def get_game(self, request):
+        key = self.get_key(request)
+        if key not in self.games:
+            self.games[key] = ByYourCommand.create(request["game_id"],
+                                                   request["user"],
+                                                   request["script_url"])
+
+        return self.games[key]
+
+    def run_page(self, request, choices, game_state, **kw):
+        result = self.get_game(request).run_page(choices, game_state, **kw)
+        if isinstance(result, Dialog):
+            return {"dialog": result.description}
+
+        return {"game_state": result}
+
+    def retrieve_game_state(self, request, force=False):
+        return self.get_game(request).retrieve_game_state(force=force)
+
+    def screenshot(self, request, html):
+        image = self.get_game(request).save_game_state_screenshot(html)
+        return {
+            "name": image.name,
+            "data": b64encode(image.getvalue()).decode()
+        }
+
+    def stop(self, request):
+        byc = self.games.pop(self.get_key(request), None)
+        if byc is not None:
+            byc.stop()
+
+    async def dispatch(self, request):
+        method = request.get("method")
+        if method not in self.METHODS:
+            return {
+                "error": {
+                    "type": "RuntimeError",
+                    "message": f"Unknown method {method}"
+                }
+            }
+
+        try:
+            result = await ByYourCommand.workers.run(request["game_id"],
+                                                     getattr(self, method),
+                                                     request,
+                                                     **request["params"])
+        except Exception as error:
+            if not isinstance(error, ValueError):
+                logging.exception("Request %s for %r", method,
+                                  self.get_key(request))
+            return {
+                "error": {
+                    "type": type(error).__name__,
+                    "message": str(error)
+                }
+            }
+
+        return {"result": result}
+
+    async def handle(self, reader, writer):
+        """
+        Handle the requests of a bot connection one at a time.
+        """
+
+        keys = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                request = json.loads(line)
+                key = self.get_key(request)
+                keys.add(key)
+                self.owners[key] = writer
+                response = await self.dispatch(request)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            logging.exception("Closing bot connection")
+        finally:
+            writer.close()
+            for key in keys:
+                if self.owners.get(key) is not writer:
+                    continue
+
+                del self.owners[key]
+                if key not in self.games:
+                    continue
+
+                try:
+                    await ByYourCommand.workers.finish(key[0], self.stop, {
+                        "game_id": key[0],
+                        "user": key[1]
+                    })
+                except Exception:
+                    logging.exception("Could not stop BYC game %s for %s",
+                                      key[0], key[1])
+
+    def close(self):
+        for byc in self.games.values():
+            byc.stop()
+
+        self.games = {}
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=getattr(logging, args.log, None))
+
+    config = Config("config.yml")
+    config.apply(remote=False)
+    ByYourCommand.pool.warm()
+
+    worker = Worker()
+    loop = asyncio.get_event_loop()
+    ByYourCommand.pool.start(loop)
+    server = loop.run_until_complete(
+        asyncio.start_server(worker.handle, args.host, args.port,
+                             limit=Worker.LIMIT)
+    )
+    logging.info("Serving BYC games on %s:%d", args.host, args.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        worker.close()
+        shared_client.close()
+        loop.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 import argparse
 import asyncio
+from hashlib import sha1
 import logging
 from pathlib import Path
 from elasticsearch_dsl.connections import connections
 from bsg.bbcode import BBCodeMarkdown
 from bsg.byc import ByYourCommand, Dialog
 from bsg.card import Cards
+from bsg.client import shared_client
 from bsg.config import Config
 from bsg.command import Command
 from bsg.command.byc import BycCommand
@@ -29,15 +31,15 @@ class SeedCommand(BycCommand):
         except IOError:
             logging.exception("Could not read game state!")
 
-        with self.get_byc() as byc:
+        async with self.get_byc() as byc:
             seed = byc.get_game_seed(game_state)
             await self.context.send(seed if key is None else seed.get(key))
 
 @Command.register("images")
 class ImagesCommand(BycCommand):
     async def run(self, **kw):
-        with self.get_byc() as byc:
-            byc.check_images(self.images)
+        async with self.get_byc() as byc:
+            await self.run_byc(byc.check_images, self.images)
 
 @Command.register("byc_succession")
 class BycSuccessionCommand(BycCommand):
@@ -51,7 +53,7 @@ class BycSuccessionCommand(BycCommand):
         except IOError:
             logging.exception("Could not read game state, starting new")
 
-        with self.get_byc() as byc:
+        async with self.get_byc() as byc:
             seed = byc.get_game_seed(game_state)
             await self.context.send(self.cards.lines_of_succession(seed))
 
@@ -99,23 +101,16 @@ class StateCommand(Command):
     async def run(self, **kw):
         thread = Thread(self.context.config['api_url'])
         game_id = self.context.config['thread_id']
-        post, seed = thread.retrieve(game_id)
+        post, seed = await thread.retrieve(game_id)
         if post is None:
             print('No latest post found!')
             return
 
-        author = thread.get_author(ByYourCommand.get_quote_author(post)[0])
+        author = await thread.get_author(ByYourCommand.get_quote_author(post)[0])
         if author is None:
             author = self.context.user
-        byc = ByYourCommand(game_id, author, self.context.config['script_url'])
-
-        choices = []
-        dialog = byc.run_page(choices, post)
-        if "You are not recognized as a player" in dialog.msg:
-            choices.extend(["\b1", "1"])
-        choices.extend(["2", "\b2", "\b0"])
-        post = byc.run_page(choices, post, num=len(choices),
-                            quits=True, quote=False)
+        post = await ByYourCommand.workers.run(game_id, self.play, game_id,
+                                               author, post)
 
         cards = Cards(self.context.config['cards_url'])
         images = Images(self.context.config['api_url'])
@@ -124,6 +119,17 @@ class StateCommand(Command):
         message = cards.replace_cards(text, display=self.context.emoji_display)
         await self.context.send(message)
 
+    def play(self, game_id, author, post):
+        with ByYourCommand.create(game_id, author,
+                                  self.context.config['script_url']) as byc:
+            choices = []
+            dialog = byc.run_page(choices, post)
+            if "You are not recognized as a player" in dialog.msg:
+                choices.extend(["\b1", "1"])
+            choices.extend(["2", "\b2", "\b0"])
+            return byc.run_page(choices, post, num=len(choices),
+                                quits=True, quote=False)
+
 @Command.register("class", "path", nargs=True)
 class ClassCommand(Command):
     async def run(self, query="", **kw):
@@ -138,15 +144,34 @@ class ClassCommand(Command):
 @Command.register("full_succession")
 class FullSuccessionCommand(Command):
     async def run(self, **kw):
-        search = Card.search(using='main').source(['path']) \
-            .filter("term", deck="char")
-        chars = list(search.scan())
+        chars = [char.path for char in Card.find(deck="char")]
         cards = Cards(self.context.config['cards_url'])
         await self.context.send(cards.lines_of_succession({
             "players": chars,
             "CFB": True
         }, unquote=False))
 
+@Command.register("script", "path")
+class ScriptCommand(Command):
+    """
+    Extract the BYC script from a saved copy of the script page and compare
+    it with the script version that is in use.
+    """
+
+    async def run(self, path=None, **kw):
+        with open(path, 'r', encoding='utf-8') as page_file:
+            script = ByYourCommand.extract_script(page_file.read()).encode()
+
+        version = sha1(script).hexdigest()
+        if ByYourCommand.SCRIPT_PATH.exists():
+            current = sha1(ByYourCommand.SCRIPT_PATH.read_bytes()).hexdigest()
+        else:
+            current = None
+
+        status = "matches" if version == current else f"differs from {current}"
+        await self.context.send(f"Extracted script version {version} "
+                                f"({len(script)} bytes) {status}")
+
 def main():
     args = parse_args()
     logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
@@ -157,6 +182,7 @@ def main():
     # Define a default Elasticsearch client
     connections.create_connection(alias='main',
                                   hosts=[config['elasticsearch_host']])
+    config.apply()
 
     name = args.command
     arguments = args.arguments
@@ -183,6 +209,7 @@ def main():
         else:
             command_loop += 1
 
+    shared_client.close()
     loop.close()
 
 if __name__ == "__main__":
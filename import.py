@@ -1,10 +1,17 @@
 import argparse
+from datetime import datetime
 from glob import glob
+from hashlib import sha1
+from itertools import islice
 import json
 import logging
+from pathlib import Path
+import sys
+from elasticsearch.helpers import bulk
 from elasticsearch_dsl.connections import connections
-import yaml
-from bsg.search import Card, Location
+from bsg.card import Cards
+from bsg.data import Data
+from bsg.search import Card, Location, SearchCache
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Command-line bot reply')
@@ -14,16 +21,22 @@ def parse_args():
     parser.add_argument('--host', default='localhost',
                         help='ElasticSearch host')
     parser.add_argument('--deck', default=None,
-                        help='Only replace this deck (no renames)')
+                        help='Only update this deck')
     parser.add_argument('--expansion', default=None,
-                        help='Only replace this expansion (no renames)')
+                        help='Only update this expansion')
     parser.add_argument('cards', nargs='*',
-                        help='Only replace these cards (no renames)')
+                        help='Only update these cards')
     parser.add_argument('--no-locations', action='store_false', default=True,
                         dest='locations', help='Skip importing board locations')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Number of documents to send per bulk request')
+    parser.add_argument('--rebuild', action='store_true', default=False,
+                        help='Build new indexes instead of updating changes')
     args = parser.parse_args()
     return args
 
+MANIFEST_PATH = Path("data/_manifest.json")
+
 def main():
     args = parse_args()
     logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
@@ -32,175 +45,279 @@ def main():
     # Define a default Elasticsearch client
     connections.create_connection(alias='main', hosts=[args.host])
 
-    if not args.cards and not args.deck and not args.expansion:
-        logging.info('Cleaning up entire index')
-        Card._index.delete(using='main', ignore=404)
-        Card.init(using='main')
+    Data.compile(sorted(glob("data/*.yml")) + ["images.yml"])
 
-    load_cards(args)
+    manifest = load_manifest()
+    filtered = bool(args.cards or args.deck or args.expansion)
+    rebuild = args.rebuild or not is_current(manifest, Card)
+    if rebuild and filtered:
+        logging.warning('No manifest of the current card index, '
+                        'so all cards are imported')
+        args.cards = []
+        args.deck = None
+        args.expansion = None
+        filtered = False
 
-    if args.locations:
-        Location._index.delete(using='main', ignore=404)
-        Location.init(using='main')
-        load_locations()
+    def in_scope(entry):
+        return (args.deck is None or entry["deck"] == args.deck) and \
+            (args.expansion is None or entry["expansion"] == args.expansion) \
+            and (not args.cards or entry["name"] in args.cards)
 
-def load_cards(args):
-    meta = {}
-    with open("data/_meta.yml", "r") as meta_file:
-        meta = yaml.safe_load(meta_file)
+    try:
+        update_index(Card, manifest, sorted(glob("data/*.yml")),
+                     lambda filenames: load_cards(args, filenames),
+                     args.batch_size, depends=["data/_meta.yml"],
+                     rebuild=rebuild, in_scope=in_scope, force=filtered)
+        Cards.load().write_names()
 
-    for filename in glob("data/*.yml"):
-        with open(filename, "r") as data_file:
-            for data in yaml.safe_load_all(data_file):
-                if data.get('meta') or 'cards' not in data:
-                    continue
+        if args.locations:
+            update_index(Location, manifest, ["data/locations.yml"],
+                         load_locations, args.batch_size,
+                         rebuild=args.rebuild or \
+                            not is_current(manifest, Location))
+    finally:
+        save_manifest(manifest)
+        SearchCache.write_generation()
 
-                load_card_section(args, data, meta)
+def load_manifest():
+    """
+    Load the manifest of content hashes of the data files and documents from
+    the previous import.
+    """
 
-def load_card_section(args, data, meta):
-    expansion = data['expansion']
-    expansion_name = meta['expansions'].get(expansion, {}).get('name', expansion)
+    try:
+        with MANIFEST_PATH.open('r') as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return {}
 
-    if args.expansion is not None and expansion != args.expansion:
-        return
+def save_manifest(manifest):
+    with MANIFEST_PATH.open('w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+def is_current(manifest, document):
+    """
+    Check whether the manifest describes the index that the alias of the
+    document class currently refers to.
+    """
+
+    client = connections.get_connection('main')
+    alias = document._index._name
+    index = manifest.get(alias, {}).get("index")
+    if index is None or not client.indices.exists_alias(name=alias):
+        return False
+
+    return index in client.indices.get_alias(name=alias)
+
+def content_hash(filenames):
+    digest = sha1()
+    for filename in filenames:
+        with open(filename, "rb") as data_file:
+            digest.update(data_file.read())
+
+    return digest.hexdigest()
+
+def document_hash(doc):
+    return sha1(json.dumps(doc.to_dict(), sort_keys=True).encode()).hexdigest()
 
-    deck = data['deck']
-    deck_name = meta['decks'][deck]['name']
+def update_index(document, manifest, filenames, loader, batch_size,
+                 depends=(), rebuild=False, in_scope=None, force=False):
+    """
+    Update the index of the document class with the documents from the data
+    files that changed since the previous import according to the manifest.
+    Only documents whose content hash changed are sent and documents that
+    are no longer in a changed data file are deleted, as long as they are in
+    scope of the import. Documents have deterministic IDs, so that an update
+    replaces the previous version of the document.
 
-    if args.deck is not None and deck != args.deck:
+    If `rebuild` is enabled, then all documents are sent to a new index.
+    If `force` is enabled, then all documents that the loader provides are
+    sent regardless of their hashes, but the data files are not recorded as
+    imported, since the loader only provides those in scope. The manifest is
+    updated for the documents that were sent successfully.
+    """
+
+    alias = document._index._name
+    section = {} if rebuild else manifest.get(alias, {})
+    files = section.get("files", {}).copy()
+    documents = section.get("documents", {}).copy()
+    hashes = {
+        filename: content_hash(list(depends) + [filename])
+        for filename in filenames
+    }
+    changed = [
+        filename for filename in filenames
+        if force or files.get(filename) != hashes[filename]
+    ]
+    removed = set(files) - set(filenames)
+    stale = {
+        doc_id: entry for doc_id, entry in documents.items()
+        if entry["file"] in changed or entry["file"] in removed
+    }
+    if not changed and not stale:
+        logging.info('No changes for %s', alias)
         return
 
-    # Deck properties
-    jump = meta['decks'][deck].get('jump')
-    ability = meta['decks'][deck].get('ability')
-    reckless = meta['decks'][deck].get('reckless')
-    agenda = data.get('agenda')
-    path = data.get('path', meta['decks'][deck].get('path', deck_name))
-    expansion_seed = data.get('seed', {})
-
-    # Insert with spaces for better Elastisearch tokenization
-    replace = data.get('replace', meta['decks'][deck].get('replace', '_'))
-    ext = data.get('ext', meta['decks'][deck].get('ext'))
-
-    for card in data['cards']:
-        if args.cards and card['name'] not in args.cards:
-            continue
-
-        if args.cards or args.deck or args.expansion:
-            try:
-                old = Card.search(using='main') \
-                    .filter("term", deck=deck) \
-                    .filter("term", expansion=expansion) \
-                    .query("match", name=card['name']).execute().hits[0]
-                old.delete(using='main')
-            except IndexError:
-                logging.warning("No hits for %s, watch for duplicates",
-                                card['name'])
-                pass
-
-        count = card.get('count')
-        if isinstance(count, int):
-            count = [count]
-
-        card_path = card.get('path', card['name'])
-        value = card.get('value')
-        if value is not None:
-            if isinstance(value, int):
-                value = [value]
-            else:
-                card_path = f"{card_path} {card['value'][0]}"
-
-        skills = card.get('skills',
-                          [card['skill']] if 'skill' in card else [])
-        cylon = card.get('cylon')
-        text = json.dumps(card.get('text', {}))
-        succession = card.get('succession', {})
-        default_succession = 99 if 'class' in card else None
-        if isinstance(expansion_seed, dict):
-            seed = card.get('seed', expansion_seed)
-        elif 'seed' in card:
-            seed = {"_expr": f"({expansion_seed}) and ({card['seed']})"}
+    def actions():
+        seen = set()
+        for filename, doc in loader(changed):
+            entry = {
+                "file": filename,
+                "hash": document_hash(doc),
+                "deck": getattr(doc, "deck", None),
+                "expansion": doc.expansion,
+                "name": doc.name
+            }
+            seen.add(doc.meta.id)
+            if force or \
+                    documents.get(doc.meta.id, {}).get("hash") != entry["hash"]:
+                yield doc.to_dict(include_meta=True)
+
+            documents[doc.meta.id] = entry
+
+        for doc_id, entry in stale.items():
+            if doc_id not in seen and (in_scope is None or in_scope(entry)):
+                logging.info('Deleting %s', doc_id)
+                del documents[doc_id]
+                yield {"_op_type": "delete", "_id": doc_id}
+
+    if rebuild:
+        index = reindex(document, actions(), batch_size)
+        errors = []
+    else:
+        index = section["index"]
+        errors = index_documents(alias, actions(), batch_size)
+
+    if not force:
+        files.update((filename, hashes[filename]) for filename in changed)
+        for filename in removed:
+            del files[filename]
+
+    for error in errors:
+        (operation, item), = error.items()
+        if operation == "delete":
+            if item.get("status") == 404:
+                continue
+
+            # Keep the document so that it is deleted again next time
+            entry = documents[item["_id"]] = stale[item["_id"]]
         else:
-            seed = {"_expr": expansion_seed}
-        if 'alternate' in card:
-            seed['_alternate'] = card['alternate']
-
-        doc = Card(name=card['name'],
-                   prefix=path,
-                   path=card_path,
-                   replace=card.get('replace', replace),
-                   url=card.get('url'),
-                   image=card.get('image'),
-                   bbox=card.get('bbox'),
-                   deck=deck,
-                   expansion=expansion,
-                   ext=card.get('ext', ext),
-                   seed=seed,
-                   index=card.get('index'),
-                   count=count,
-                   value=value,
-                   destination=card.get('destination'),
-                   text=text,
-                   skills=skills,
-                   cylon=[cylon] if isinstance(cylon, str) else cylon,
-                   jump=card.get('jump', jump),
-                   character_class=card.get('class'),
-                   president=succession.get('president', default_succession),
-                   admiral=succession.get('admiral', default_succession),
-                   cag=succession.get('cag', default_succession),
-                   allegiance=card.get('allegiance'),
-                   ability=card.get('ability', ability),
-                   reckless=card.get('reckless', reckless),
-                   agenda=agenda)
-        logging.debug('%r', doc.to_dict())
-        doc.save(using='main')
-        logging.info('Saved %s (%s card from %s)', card['name'],
-                     deck_name, expansion_name)
-
-def load_locations():
-    with open("data/locations.yml", "r") as locations_file:
-        for data in yaml.safe_load_all(locations_file):
-            expansion = data['expansion']
-            expansion_seed = data.get('seed', {})
-            for board in data['boards']:
-                board_name = board['name']
-                path = board.get('path', board_name)
-                image = board.get('image')
-                ext = board['ext']
-                seed = board.get('seed', expansion_seed)
-                doc = Location(board_name=board_name,
-                               path=path,
-                               image=image,
-                               ext=ext,
-                               name=board_name,
-                               expansion=expansion,
-                               seed=seed,
-                               bbox=board.get('bbox'),
-                               text=json.dumps({}))
-                doc.save(using='main')
-                logging.info('Saved %s (board from %s)',
-                             board_name, expansion)
-                for location in board['locations']:
-                    value = location.get('value')
-                    if isinstance(value, int):
-                        value = [value]
-                    loc = Location(board_name=board_name,
-                                   path=path,
-                                   image=image,
-                                   ext=ext,
-                                   name=location['name'],
-                                   expansion=expansion,
-                                   seed=seed,
-                                   hazardous=location.get('hazardous', False),
-                                   bbox=location.get('bbox'),
-                                   value=value,
-                                   skills=location.get('skills'),
-                                   occupation=location.get('occupation'),
-                                   text=json.dumps(location.get('text', {})))
-                    logging.debug('%r', loc.to_dict())
-                    loc.save(using='main')
-                    logging.info('Saved %s (%s location from %s)',
-                                 location['name'], board_name, expansion)
+            entry = documents.pop(item["_id"])
+
+        # Import the data file again next time
+        files.pop(entry["file"], None)
+
+    manifest[alias] = {
+        "index": index,
+        "files": files,
+        "documents": documents
+    }
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+def reindex(document, actions, batch_size):
+    """
+    Build a new, versioned index for the document class and fill it using
+    the bulk actions. The alias with the name of the document index is then
+    moved to the new index in one atomic operation, so that searches keep
+    working during the import. Older versions of the index are deleted
+    afterward. Returns the name of the new index.
+
+    If any of the bulk actions fail, then the new index is deleted instead
+    and the import exits with an error, leaving the alias and older versions
+    of the index in place.
+    """
+
+    client = connections.get_connection('main')
+    alias = document._index._name
+    name = f"{alias}-{datetime.now():%Y%m%d%H%M%S}"
+    document.init(index=name, using='main')
+    errors = index_documents(name, actions, batch_size)
+    if errors:
+        logging.error('%d actions failed, so %s is deleted and alias %s is '
+                      'kept', len(errors), name, alias)
+        client.indices.delete(index=name, ignore=404)
+        sys.exit(1)
+
+    actions = [{"add": {"index": name, "alias": alias}}]
+    if client.indices.exists_alias(name=alias):
+        actions.extend({"remove": {"index": old, "alias": alias}}
+                       for old in client.indices.get_alias(name=alias))
+    elif client.indices.exists(index=alias):
+        # Index from before versioned indexes, which must make way for alias
+        actions.append({"remove_index": {"index": alias}})
+
+    client.indices.update_aliases(body={"actions": actions})
+    logging.info('Alias %s now refers to %s', alias, name)
+
+    for old in client.indices.get(index=f"{alias}-*"):
+        if old != name:
+            logging.info('Deleting old index %s', old)
+            client.indices.delete(index=old, ignore=404)
+
+    return name
+
+def index_documents(index, actions, batch_size):
+    """
+    Send bulk actions from an iterable to an index in batches of `batch_size`
+    actions. Refreshes of the index are disabled until all batches have been
+    sent, after which one refresh is performed. Returns the errors of the
+    actions that failed.
+    """
+
+    iterator = batches(actions, batch_size)
+    batch = next(iterator, None)
+    if batch is None:
+        logging.info('Nothing to send to %s', index)
+        return []
+
+    client = connections.get_connection('main')
+    client.indices.put_settings(index=index,
+                                body={"index": {"refresh_interval": "-1"}})
+    total = 0
+    failed = []
+    try:
+        number = 1
+        while batch is not None:
+            batch = [dict(action, _index=index) for action in batch]
+            success, errors = bulk(client, batch, chunk_size=batch_size,
+                                   raise_on_error=False)
+            total += success
+            failed.extend(errors)
+            logging.info('Batch #%d: %d of %d actions succeeded', number,
+                         success, len(batch))
+            for error in errors:
+                logging.error('Batch #%d: %r', number, error)
+
+            batch = next(iterator, None)
+            number += 1
+    finally:
+        client.indices.put_settings(index=index,
+                                    body={"index": {"refresh_interval": None}})
+        client.indices.refresh(index=index)
+
+    logging.info('Performed %d actions on %s (%d failed)', total, index,
+                 len(failed))
+    return failed
+
+def load_cards(args, filenames):
+    for filename, doc in Card.from_data(filenames, deck=args.deck,
+                                        expansion=args.expansion,
+                                        names=args.cards):
+        logging.info('Loaded %s (%s card from %s)', doc.name, doc.deck,
+                     doc.expansion)
+        yield filename, doc
+
+def load_locations(filenames):
+    for filename, doc in Location.from_data(filenames):
+        logging.info('Loaded %s (%s location from %s)', doc.name,
+                     doc.board_name, doc.expansion)
+        yield filename, doc
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+def pytest_sessionstart(session):
+    # The repository root is not a package. It is added to the path only once
+    # pytest started, since its cmd.py shadows the standard module that the
+    # debugger plugin of pytest imports.
+    sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,61 @@
+import random
+import re
+from pathlib import Path
+import pytest
+from bsg.byc import ByYourCommand
+
+FIXTURES_PATH = Path(__file__).parent / "fixtures"
+
+def extract_script_regex(src):
+    """
+    Extraction of the script parts with one regular expression per part, as
+    it was done before the single-pass extractor.
+    """
+
+    qre = []
+    for tag in ["A", "B", "C", "D", "E", "F"]:
+        qre.append(re.compile(fr"STARTBYC{tag}(?:(?!(STARTBYC|ENDBYC)).)*ENDBYC{tag}"))
+
+    totaljs = ""
+    startchar = 9
+    endchar = -7
+    for part in qre:
+        match = part.search(src)
+        if not match:
+            raise RuntimeError("Could not read script.")
+        totaljs += match.group(0)[startchar:endchar]
+
+    return totaljs.replace("&gt;", ">").replace("&amp;", "&")
+
+def test_extract_script_page():
+    src = (FIXTURES_PATH / "byc_script_page.html").read_text()
+    script = ByYourCommand.extract_script(src)
+    assert script == extract_script_regex(src)
+    assert script.startswith('var BYC = window.BYC || {};')
+    assert 'BYC.debug && window.console' in script
+    assert 'BYC.compare = null' not in script
+    assert script.endswith('BYC.start();')
+
+def test_extract_script_missing_part():
+    src = (FIXTURES_PATH / "byc_script_page.html").read_text()
+    src = src.replace("ENDBYCD", "")
+    with pytest.raises(RuntimeError):
+        extract_script_regex(src)
+    with pytest.raises(RuntimeError):
+        ByYourCommand.extract_script(src)
+
+def test_extract_script_random():
+    # Pages made of markers with overlapping tag characters, line breaks and
+    # other text, where both extractions must agree
+    rng = random.Random(18)
+    pieces = ["STARTBYC", "ENDBYC", "A", "B", "C", "D", "E", "F", "\n", "x",
+              "&gt;", "&amp;"]
+    for _ in range(20000):
+        src = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 40)))
+        try:
+            expected = extract_script_regex(src)
+        except RuntimeError:
+            with pytest.raises(RuntimeError):
+                ByYourCommand.extract_script(src)
+        else:
+            assert ByYourCommand.extract_script(src) == expected